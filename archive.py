@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Write exported messages to a single SQLite archive, and search it.
+
+Messages are given as records, tuples of
+(id, sent_at, sender, type, body, attachments, reactions) where attachments
+is a list of (file_name, content_type, path, size) and reactions a list of
+(emoji, sender). Message bodies are indexed with FTS5 when SQLite has it.
+"""
+
+import sqlite3
+import sys
+from datetime import datetime
+
+import click
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations(
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    number TEXT,
+    is_group INTEGER
+);
+CREATE TABLE IF NOT EXISTS messages(
+    rowid INTEGER PRIMARY KEY,
+    id TEXT UNIQUE,
+    conversation_id TEXT REFERENCES conversations(id),
+    sent_at INTEGER,
+    sender TEXT,
+    type TEXT,
+    body TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_conversation
+    ON messages (conversation_id, sent_at);
+CREATE INDEX IF NOT EXISTS messages_sent_at ON messages (sent_at);
+CREATE TABLE IF NOT EXISTS attachments(
+    message_id TEXT REFERENCES messages(id),
+    position INTEGER,
+    file_name TEXT,
+    content_type TEXT,
+    path TEXT,
+    size INTEGER,
+    PRIMARY KEY (message_id, position)
+);
+CREATE TABLE IF NOT EXISTS reactions(
+    message_id TEXT REFERENCES messages(id),
+    emoji TEXT,
+    sender TEXT
+);
+CREATE INDEX IF NOT EXISTS reactions_message ON reactions (message_id);
+"""
+
+# external content index over messages.body, kept in sync by triggers
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    body, content='messages', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, body) VALUES (new.rowid, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, body)
+        VALUES ('delete', old.rowid, old.body);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, body)
+        VALUES ('delete', old.rowid, old.body);
+    INSERT INTO messages_fts (rowid, body) VALUES (new.rowid, new.body);
+END;
+"""
+
+
+def has_fts(db):
+    return (
+        db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+        ).fetchone()
+        is not None
+    )
+
+
+def open_archive(path):
+    """Open the archive at path, creating its tables if needed."""
+
+    db = sqlite3.connect(str(path))
+    db.executescript(SCHEMA)
+    try:
+        db.executescript(FTS_SCHEMA)
+    except sqlite3.OperationalError:
+        # SQLite built without FTS5, search falls back to LIKE
+        print("No FTS5 in SQLite, the archive will not have a full text index")
+    return db
+
+
+def add_conversation(db, id, name, number=None, is_group=False):
+    db.execute(
+        "INSERT INTO conversations (id, name, number, is_group) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET name = excluded.name, "
+        "number = excluded.number, is_group = excluded.is_group",
+        (id, name, number, int(is_group)),
+    )
+
+
+def add_messages(db, conversation_id, records):
+    """Add the records of a conversation, replacing messages already archived.
+
+    Returns the number of messages added.
+    """
+
+    count = 0
+    with db:
+        for id, sent_at, sender, type, body, attachments, reactions in records:
+            db.execute(
+                "INSERT INTO messages (id, conversation_id, sent_at, sender, type, body) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET conversation_id = excluded.conversation_id, "
+                "sent_at = excluded.sent_at, sender = excluded.sender, "
+                "type = excluded.type, body = excluded.body",
+                (id, conversation_id, sent_at, sender, type, body),
+            )
+            db.execute("DELETE FROM attachments WHERE message_id = ?", (id,))
+            db.executemany(
+                "INSERT INTO attachments "
+                "(message_id, position, file_name, content_type, path, size) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(id, i, *att) for i, att in enumerate(attachments)],
+            )
+            db.execute("DELETE FROM reactions WHERE message_id = ?", (id,))
+            db.executemany(
+                "INSERT INTO reactions (message_id, emoji, sender) VALUES (?, ?, ?)",
+                [(id, *reaction) for reaction in reactions],
+            )
+            count += 1
+    return count
+
+
+def search(db, query, chat=None, limit=20):
+    """Return (chat, sent_at, sender, snippet) for the messages matching query.
+
+    query uses the FTS5 syntax, best matches first; without FTS5 it is
+    matched as a substring, newest first.
+    """
+
+    params = []
+    chat_filter = ""
+    if chat is not None:
+        chat_filter = " AND c.name = ?"
+    if has_fts(db):
+        sql = (
+            "SELECT c.name, m.sent_at, m.sender, "
+            "snippet(messages_fts, 0, '[', ']', '...', 12) "
+            "FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid "
+            "JOIN conversations c ON c.id = m.conversation_id "
+            f"WHERE messages_fts MATCH ?{chat_filter} ORDER BY rank LIMIT ?"
+        )
+    else:
+        sql = (
+            "SELECT c.name, m.sent_at, m.sender, m.body "
+            "FROM messages m JOIN conversations c ON c.id = m.conversation_id "
+            f"WHERE m.body LIKE '%' || ? || '%'{chat_filter} "
+            "ORDER BY m.sent_at DESC LIMIT ?"
+        )
+    params.append(query)
+    if chat is not None:
+        params.append(chat)
+    params.append(limit)
+    return db.execute(sql, params).fetchall()
+
+
+@click.command(name="search")
+@click.argument("archive", type=click.Path(exists=True, dir_okay=False))
+@click.argument("query")
+@click.option("--chat", help="Only search the chat with this name")
+@click.option("--limit", "-n", type=int, default=20, help="Number of results")
+def main(archive, query, chat=None, limit=20):
+    """
+    Search the messages of an ARCHIVE written by sigexport.py --archive.
+
+    QUERY uses the SQLite FTS5 syntax: words, "exact phrases", prefix*,
+    AND/OR/NOT.
+    """
+
+    db = sqlite3.connect(str(archive))
+    try:
+        results = search(db, query, chat, limit)
+    except sqlite3.OperationalError as e:
+        print(f"Invalid search query: {e}")
+        sys.exit(1)
+    finally:
+        db.close()
+    for name, sent_at, sender, snippet in results:
+        date = "????-??-?? ??:??"
+        if sent_at is not None:
+            date = datetime.fromtimestamp(sent_at / 1000.0).strftime("%Y-%m-%d %H:%M")
+        snippet = " ".join((snippet or "").split())
+        print(f"[{date}] {name} / {sender}: {snippet}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import errno
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, reflinks fall back to a plain copy there
+    fcntl = None
+
+COPY_MODES = ["copy", "hardlink", "reflink"]
+
+# ioctl request number of FICLONE on Linux
+FICLONE = 0x40049409
+
+# errors meaning a link/clone is not possible here, rather than a missing file
+FALLBACK_ERRNOS = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EMLINK,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.ENOSYS,
+}
+
+
+def hardlink(src, dst):
+    """Hardlink src to dst, copying instead when they are on different filesystems."""
+
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in FALLBACK_ERRNOS:
+            raise
+        shutil.copy2(src, dst)
+
+
+def reflink(src, dst):
+    """Clone src to dst without copying bytes when the filesystem allows it.
+
+    Tries FICLONE first (btrfs, xfs, ...), then copy_file_range which lets
+    the kernel copy in place, and finally a regular copy.
+    """
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            if fcntl is None:
+                raise OSError(errno.ENOSYS, "FICLONE not available")
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+            copy_range(fsrc, fdst)
+    shutil.copystat(src, dst)
+
+
+def copy_range(fsrc, fdst):
+    """Copy between open files with copy_file_range, or in userspace if unsupported."""
+
+    size = os.fstat(fsrc.fileno()).st_size
+    copied = 0
+    try:
+        while copied < size:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+            if n == 0:
+                break
+            copied += n
+    except (AttributeError, OSError) as e:
+        if isinstance(e, OSError) and e.errno not in FALLBACK_ERRNOS:
+            raise
+        fsrc.seek(copied)
+        fdst.seek(copied)
+        shutil.copyfileobj(fsrc, fdst)
+
+
+def same_file(src, dst):
+    try:
+        return os.path.samefile(src, dst)
+    except OSError:
+        return False
+
+
+def copy_file(src, dst, mode="copy"):
+    """Copy one file using the given mode (see COPY_MODES).
+
+    An existing dst is replaced, never written to: it may be a hardlink to
+    a file of Signal or of another export. A dst that is src already is
+    left as is.
+    """
+
+    if same_file(src, dst):
+        return
+    if mode == "hardlink":
+        hardlink(src, dst)
+        return
+    tmp = f"{dst}.{threading.get_ident()}.tmp"
+    try:
+        if mode == "reflink":
+            reflink(src, tmp)
+        else:
+            shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def file_hash(path):
+    """SHA-256 of the content of the file at path, as hex."""
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def link(src, dst):
+    """Hardlink src to dst, or symlink it relatively where hardlinks are not possible."""
+
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in FALLBACK_ERRNOS:
+            raise
+        try:
+            os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+            shutil.copy2(src, dst)
+
+
+class MediaStore:
+    """Content-addressed store of attachments, shared by all the chats of an export.
+
+    Each distinct content is copied once, to root/<ab>/<sha256>, and the
+    files of the chats' media/ folders are links to it, so that a file
+    forwarded to many chats takes space and copy time once.
+    """
+
+    def __init__(self, root, mode="copy"):
+        self.root = root
+        self.mode = mode
+        # digests of the source files hashed so far, by path
+        self.digests = {}
+        self.lock = threading.Lock()
+        self.content_locks = {}
+        self.stored = 0
+        self.linked = 0
+        self.bytes = 0
+
+    def digest(self, src, digest=None):
+        """The SHA-256 of src: digest when known (Signal's plaintextHash), else hashed."""
+
+        if digest:
+            return digest.lower()
+        src = str(src)
+        with self.lock:
+            digest = self.digests.get(src)
+        if digest is None:
+            digest = file_hash(src)
+            with self.lock:
+                self.digests[src] = digest
+        return digest
+
+    def path(self, digest):
+        return self.root / digest[:2] / digest
+
+    def add(self, src, digest=None):
+        """Put src in the store unless its content already is; returns its stored path."""
+
+        digest = self.digest(src, digest)
+        stored = self.path(digest)
+        with self.lock:
+            # one lock per content, so that it is copied by a single thread
+            content_lock = self.content_locks.setdefault(digest, threading.Lock())
+        with content_lock:
+            if not stored.exists():
+                stored.parent.mkdir(parents=True, exist_ok=True)
+                # an interrupted copy never leaves a truncated file in the store
+                tmp = stored.with_name(stored.name + ".tmp")
+                copy_file(src, tmp, self.mode)
+                os.replace(tmp, stored)
+                with self.lock:
+                    self.stored += 1
+                    self.bytes += os.path.getsize(stored)
+        return stored
+
+    def copy(self, src, dst, digest=None):
+        """Make dst a link to the stored copy of src."""
+
+        link(self.add(src, digest), dst)
+        with self.lock:
+            self.linked += 1
+
+
+def copy_files(jobs, mode="copy", workers=8, store=None):
+    """Copy files concurrently.
+
+    jobs is a list of (source, destination, info) tuples, where info is a dict
+    describing the file. With a MediaStore, files are copied through it, using
+    the SHA-256 in info["hash"] if any. Returns the list of failures: for
+    each file that could not be copied, its info dict with "source" and
+    "error" added.
+    """
+
+    def run(job):
+        src, dst, info = job
+        try:
+            if store is not None:
+                store.copy(src, dst, info.get("hash"))
+            else:
+                copy_file(src, dst, mode)
+        except OSError as e:
+            return {**info, "source": str(src), "error": f"{type(e).__name__}: {e}"}
+        return None
+
+    if workers <= 1:
+        results = map(run, jobs)
+        return [failure for failure in results if failure is not None]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [failure for failure in pool.map(run, jobs) if failure is not None]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import shutil
+import time
+from pathlib import Path
+
+import click
+
+import sigexport
+from attachments import COPY_MODES
+from get_data import fetch_data, filter_data, stream_data
+from synthetic_db import generate
+
+
+def run_stage(results, name, func, count=None):
+    """Time func(), record the stage in results and return func's result.
+
+    count maps the result to the number of items the stage handled.
+    """
+
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    items = count(result) if count else None
+    results.append((name, seconds, items))
+    return result
+
+
+def count_messages(convos):
+    return sum(len(messages) for messages in convos.values())
+
+
+def count_lines(dest):
+    return sum(
+        sum(1 for _ in open(md, encoding="utf-8")) for md in dest.glob("*/index.md")
+    )
+
+
+def drain(data):
+    gen, contacts = data
+    return sum(len(messages) for _, messages in gen)
+
+
+def print_results(results):
+    print(f"\n{'stage':<20}{'seconds':>10}{'items':>10}{'items/s':>12}")
+    for name, seconds, items in results:
+        if items is None:
+            print(f"{name:<20}{seconds:>10.3f}{'-':>10}{'-':>12}")
+        else:
+            rate = items / seconds if seconds else float("inf")
+            print(f"{name:<20}{seconds:>10.3f}{items:>10}{rate:>12.0f}")
+
+
+@click.command()
+@click.argument("workdir", type=click.Path(), default="benchmark")
+@click.option("--chats", type=int, default=20, help="Number of private chats")
+@click.option("--messages", type=int, default=10_000, help="Number of messages")
+@click.option("--groups", type=int, default=5, help="Number of group chats")
+@click.option(
+    "--attachment-ratio",
+    type=float,
+    default=0.05,
+    help="Share of messages with attachments",
+)
+@click.option("--seed", type=int, default=0, help="Random seed")
+@click.option(
+    "--regenerate", is_flag=True, default=False, help="Rebuild the synthetic profile"
+)
+@click.option(
+    "--copy-mode",
+    type=click.Choice(COPY_MODES),
+    default="copy",
+    help="How attachments are copied",
+)
+@click.option("--jobs", "-j", type=int, default=1, help="HTML rendering processes")
+def main(
+    workdir,
+    chats=20,
+    messages=10_000,
+    groups=5,
+    attachment_ratio=0.05,
+    seed=0,
+    regenerate=False,
+    copy_mode="copy",
+    jobs=1,
+):
+    """
+    Time each stage of an export of a synthetic Signal profile.
+
+    The profile is generated in WORKDIR/source (unless it already exists) and
+    exported to WORKDIR/output, which is overwritten.
+    """
+
+    workdir = Path(workdir)
+    src = workdir / "source"
+    dest = workdir / "output"
+    db_file = src / "sql" / "db.sqlite"
+    results = []
+
+    if regenerate or not db_file.exists():
+        run_stage(
+            results,
+            "generate",
+            lambda: generate(
+                src,
+                chats=chats,
+                messages=messages,
+                groups=groups,
+                attachment_ratio=attachment_ratio,
+                seed=seed,
+            ),
+        )
+    if dest.exists():
+        shutil.rmtree(dest)
+    dest.mkdir(parents=True)
+
+    convos, contacts = run_stage(
+        results,
+        "fetch_data",
+        lambda: fetch_data(db_file, None),
+        lambda data: count_messages(data[0]),
+    )
+    convos, contacts = run_stage(
+        results,
+        "filter_data",
+        lambda: filter_data(convos, contacts),
+        lambda data: count_messages(data[0]),
+    )
+    contacts = sigexport.fix_names(contacts)
+    senders = sigexport.build_sender_index(contacts)
+    run_stage(
+        results,
+        "copy_attachments",
+        lambda: sigexport.copy_attachments(src, dest, convos, contacts, copy_mode),
+        lambda failures: sum(
+            len(msg.attachments or ())
+            for messages in convos.values()
+            for msg in messages
+        ),
+    )
+    run_stage(
+        results,
+        "make_simple",
+        lambda: sigexport.make_simple(dest, convos, contacts, senders),
+        lambda _: count_messages(convos),
+    )
+
+    # merging the export with a copy of itself exercises the dedupe path
+    old = workdir / "old"
+    if old.exists():
+        shutil.rmtree(old)
+    shutil.copytree(dest, old)
+    run_stage(
+        results,
+        "merge_chat",
+        lambda: sigexport.merge_with_old(dest, old),
+        lambda _: count_lines(dest),
+    )
+    shutil.rmtree(old)
+
+    run_stage(
+        results,
+        "create_html",
+        lambda: sigexport.create_html(
+            dest,
+            conversations=convos,
+            contacts=contacts,
+            senders=senders,
+            jobs=jobs,
+        ),
+        lambda _: count_messages(convos),
+    )
+    run_stage(
+        results,
+        "stream_data",
+        lambda: drain(stream_data(db_file, None)),
+        lambda total: total,
+    )
+
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
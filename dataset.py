@@ -0,0 +1,66 @@
+"""Write exported messages as a dataset of gzip compressed JSON lines files.
+
+Messages are given as dicts, one per line of messages-NNNNN.jsonl.gz files
+holding FILE_MESSAGES messages each, so that they can be processed in
+parallel; conversations.jsonl.gz lists the conversations. Files are written
+from streams, so memory use does not grow with the number of messages.
+"""
+
+import gzip
+import json
+import os
+from itertools import chain, islice
+
+FILE_MESSAGES = 100_000
+# level 6 compresses nearly as well as 9, at a fraction of its CPU time
+COMPRESS_LEVEL = 6
+MESSAGES_PREFIX = "messages-"
+SUFFIX = ".jsonl.gz"
+CONVERSATIONS_FILE = "conversations" + SUFFIX
+
+
+def messages_file(num):
+    return f"{MESSAGES_PREFIX}{num:05}{SUFFIX}"
+
+
+def write_jsonl(path, records):
+    """Write records to path as gzip compressed JSON lines.
+
+    The file replaces path once complete, so an interrupted run never leaves
+    a truncated one. Returns the number of records written.
+    """
+
+    count = 0
+    tmp = path.with_name(path.name + ".tmp")
+    with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=COMPRESS_LEVEL) as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+            f.write("\n")
+            count += 1
+    os.replace(tmp, path)
+    return count
+
+
+def write_dataset(folder, messages, conversations, file_messages=FILE_MESSAGES):
+    """Write the messages and conversations dicts to folder.
+
+    Returns the number of messages written.
+    """
+
+    messages = iter(messages)
+    total = 0
+    num = 0
+    for first in messages:
+        total += write_jsonl(
+            folder / messages_file(num),
+            chain([first], islice(messages, file_messages - 1)),
+        )
+        num += 1
+
+    # files left over from a previous, larger dataset
+    for stale in folder.glob(f"{MESSAGES_PREFIX}*{SUFFIX}"):
+        part = stale.name[len(MESSAGES_PREFIX):-len(SUFFIX)]
+        if not part.isdigit() or int(part) >= num:
+            stale.unlink()
+    write_jsonl(folder / CONVERSATIONS_FILE, conversations)
+    return total
@@ -1,8 +1,26 @@
 from pysqlcipher3 import dbapi2 as sqlcipher
+import sqlite3
+import atexit
+import hashlib
 import json
+import os
+import subprocess
 import uuid
 import sys
 from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+
+from model import JSON_FIELDS, Message, Reaction
+
+# decrypted copies kept by --snapshot-cache, readable only by the user
+SNAPSHOT_DIR = Path.home() / ".cache" / "sigexport" / "snapshots"
+
+# a JSON array of the model.JSON_FIELDS of the json column, in order
+PROJECTION = "json_extract(json, {})".format(
+    ", ".join(f"'$.{field}'" for field in JSON_FIELDS)
+)
 
 def print_db_schema(db_file, key):
     """Prints the schema of the SQLite database."""
@@ -30,62 +48,303 @@ def print_db_schema(db_file, key):
 
 
 def add_file_name(msg, log):
-    if 'attachments' in msg and isinstance(msg['attachments'], list):
-        for att in msg['attachments']:
-            if 'fileName' not in att or not att['fileName']:
+    if msg.attachments:
+        for att in msg.attachments:
+            if not att.file_name:
                 # Generate a unique file name based on contentType
                 extension = determine_extension(att)
                 random_name = str(uuid.uuid4())
-                att['fileName'] = random_name + extension
+                att.file_name = random_name + extension
                 if log:
-                    print(f"Generated fileName: {att['fileName']} for attachment in message: {msg.get('id')}")
+                    print(f"Generated fileName: {att.file_name} for attachment in message: {msg.id}")
 
     return msg  # Return the modified message
 
 
 def determine_extension(att):
-    return '.' + att['contentType'].split('/')[1]
+    return '.' + att.content_type.split('/')[1]
 
 
-def fetch_data(db_file, key, manual=False, chats=None, conversation_id=None, log=False):
-    """Load SQLite data into dicts."""
+def year_bounds(year):
+    """Return the first and last millisecond timestamps of a year (local time)."""
 
-    contacts = {}
-    convos = {}
+    start = datetime(year, 1, 1).timestamp() * 1000
+    end = datetime(year + 1, 1, 1).timestamp() * 1000
+    return int(start), int(end) - 1
 
-    db_file_decrypted = db_file.parents[0] / "db-decrypt.sqlite"
-    if manual:
-        if db_file_decrypted.exists():
-            db_file_decrypted.unlink()
-        command = (
-            f'echo "'
-            f"PRAGMA key = \\\"x'{key}'\\\";"
-            f"ATTACH DATABASE '{db_file_decrypted}' AS plaintext KEY '';"
-            f"SELECT sqlcipher_export('plaintext');"
-            f"DETACH DATABASE plaintext;"
-            f'" | sqlcipher {db_file}'
+
+# with --incremental, the messages to read are joined from the temporary
+# export_marks table written by load_marks: those of each conversation from
+# its mark on, and all those of the conversations without a mark. With the
+# marks table first, SQLite seeks each conversation in the
+# (conversationId, sent_at) index rather than scanning messages.
+MARK_JOINS = (
+    "export_marks t CROSS JOIN messages m "
+    "ON m.conversationId = t.cid AND m.sent_at >= t.sent_at",
+    "export_marks t CROSS JOIN messages m "
+    "ON m.conversationId = t.cid AND t.sent_at IS NULL",
+)
+
+
+def build_message_filter(
+    conversation_ids=None,
+    year=None,
+    attachments_only=False,
+    alias=None,
+):
+    """Turn the export filters into a parameterized WHERE clause on messages.
+
+    Returns the clause (empty when nothing is filtered) and the list of
+    parameters to bind to it. Columns are prefixed with alias if given.
+    """
+
+    prefix = f"{alias}." if alias else ""
+    clauses = []
+    params = []
+    if conversation_ids is not None:
+        placeholders = ",".join("?" * len(conversation_ids))
+        clauses.append(f"{prefix}conversationId IN ({placeholders})")
+        params.extend(conversation_ids)
+    if year is not None:
+        clauses.append(f"{prefix}sent_at BETWEEN ? AND ?")
+        params.extend(year_bounds(year))
+    if attachments_only:
+        clauses.append(f"{prefix}hasAttachments = 1")
+
+    if not clauses:
+        return "", params
+    return " WHERE " + " AND ".join(clauses), params
+
+
+def build_message_query(
+    conversation_ids=None,
+    year=None,
+    attachments_only=False,
+    order_by="sent_at",
+    marks=False,
+    projection=False,
+):
+    """Build the messages query and its parameters from the export filters.
+
+    Rows are (json, conversationId, id, sent_at). With projection, the first
+    column only holds the JSON_FIELDS of json, as an array. With marks, only
+    the messages after the marks of load_marks are read.
+    """
+
+    where, params = build_message_filter(
+        conversation_ids, year, attachments_only, alias="m"
+    )
+    # named, as ORDER BY can only refer to columns by name after a UNION
+    columns = "m.conversationId AS conversationId, m.id AS id, m.sent_at AS sent_at"
+    columns = f"{PROJECTION if projection else 'm.json'}, {columns}"
+    if not marks:
+        query = f"SELECT {columns} FROM messages m{where} ORDER BY {order_by}"
+        return query, params
+    query = " UNION ALL ".join(
+        f"SELECT {columns} FROM {join}{where}" for join in MARK_JOINS
+    )
+    return f"{query} ORDER BY {order_by}", params * len(MARK_JOINS)
+
+
+def build_reactions_query(
+    conversation_ids=None, year=None, attachments_only=False, marks=False
+):
+    """Build a query for the reactions to the exported messages only.
+
+    Rows are (messageId, emoji, fromId, conversationId), ordered by
+    conversation so they can be read alongside a streamed message cursor.
+    """
+
+    where, params = build_message_filter(
+        conversation_ids, year, attachments_only, alias="m"
+    )
+    # messages without a conversation are not exported, and NULL ids could
+    # not be compared with the ones of the message cursor
+    where += " AND" if where else " WHERE"
+    where += " m.conversationId IS NOT NULL"
+    columns = "r.messageId, r.emoji, r.fromId, m.conversationId AS conversationId"
+    if not marks:
+        query = (
+            f"SELECT {columns} FROM reactions r JOIN messages m ON m.id = r.messageId"
+            f"{where} ORDER BY m.conversationId"
         )
-        os.system(command)
+        return query, params
+    query = " UNION ALL ".join(
+        f"SELECT {columns} FROM {join} JOIN reactions r ON r.messageId = m.id{where}"
+        for join in MARK_JOINS
+    )
+    return f"{query} ORDER BY conversationId", params * len(MARK_JOINS)
+
+
+def connect_encrypted(db_file, key):
+    db = sqlcipher.connect(str(db_file))
+    c = db.cursor()
+    # param binding doesn't work for pragmas, so use a direct string concat
+    c.execute(f"PRAGMA KEY = \"x'{key}'\"")
+    c.execute("PRAGMA cipher_page_size = 4096")
+    c.execute("PRAGMA kdf_iter = 64000")
+    c.execute("PRAGMA cipher_hmac_algorithm = HMAC_SHA512")
+    c.execute("PRAGMA cipher_kdf_algorithm = PBKDF2_HMAC_SHA512")
+    return db
+
+
+def export_plaintext(db_file, key, dest, manual=False):
+    """Write a decrypted copy of db_file to dest, readable only by the user.
+
+    With manual, the sqlcipher command line tool does the decryption
+    (the key is passed on its stdin, not its command line).
+    """
+
+    dest = Path(dest)
+    if dest.exists():
+        dest.unlink()
+    # create it empty first, so that it never exists with wider permissions
+    os.close(os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+    attach = str(dest).replace("'", "''")
+    export = (
+        f"ATTACH DATABASE '{attach}' AS plaintext KEY '';"
+        "SELECT sqlcipher_export('plaintext');"
+        "DETACH DATABASE plaintext;"
+    )
+    try:
+        if manual:
+            subprocess.run(
+                ["sqlcipher", "-bail", str(db_file)],
+                input=f"PRAGMA key = \"x'{key}'\";" + export,
+                stdout=subprocess.DEVNULL,
+                text=True,
+                check=True,
+            )
+        else:
+            db = connect_encrypted(db_file, key)
+            try:
+                db.cursor().executescript(export)
+            finally:
+                db.close()
+    except BaseException:
+        dest.unlink()
+        raise
+
+
+def db_fingerprint(db_file):
+    """Identify the state of db_file by the mtime and size of it and its WAL."""
+
+    fingerprint = {}
+    for path in (Path(db_file), Path(f"{db_file}-wal")):
+        if path.exists():
+            stat = path.stat()
+            fingerprint[path.name] = [stat.st_mtime_ns, stat.st_size]
+    return fingerprint
+
+
+def snapshot_db(db_file, key, manual=False, cache_dir=SNAPSHOT_DIR):
+    """Return the path of a decrypted snapshot of db_file in cache_dir.
+
+    The snapshot is reused as long as the mtime and size of the database
+    (and of its WAL) are unchanged, and made again otherwise.
+    """
+
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    os.chmod(cache_dir, 0o700)
+    name = hashlib.sha256(str(Path(db_file).resolve()).encode("utf-8")).hexdigest()[:16]
+    snapshot = cache_dir / f"{name}.sqlite"
+    meta = cache_dir / f"{name}.json"
+
+    fingerprint = db_fingerprint(db_file)
+    try:
+        with open(meta) as f:
+            if json.load(f) == fingerprint and snapshot.exists():
+                return snapshot
+    except (OSError, ValueError):
+        pass
+
+    # a snapshot without its metadata is never reused
+    if meta.exists():
+        meta.unlink()
+    partial = cache_dir / f"{name}.partial"
+    export_plaintext(db_file, key, partial, manual)
+    os.replace(partial, snapshot)
+    fd = os.open(meta, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(fingerprint, f)
+    return snapshot
+
+
+def remove_decrypted(path):
+    if path is not None and path.exists():
+        path.unlink()
+
+
+def open_db(db_file, key, manual=False, snapshot=False):
+    """Open the Signal database.
+
+    Returns the connection and the path of the decrypted copy made with
+    --manual (None otherwise), which the caller must delete when done with
+    remove_decrypted. It is removed at exit too, should the caller never
+    get there (e.g. a stream that is never consumed).
+    With snapshot, the decrypted copy is kept in SNAPSHOT_DIR and reused by
+    later runs instead (see snapshot_db).
+    A key of None opens an unencrypted database, such as the ones made by
+    synthetic_db.py.
+    """
+
+    if key is None:
+        return sqlite3.connect(str(db_file)), None
+
+    if snapshot:
+        return sqlcipher.connect(str(snapshot_db(db_file, key, manual))), None
+
+    if manual:
+        db_file_decrypted = db_file.parents[0] / "db-decrypt.sqlite"
+        export_plaintext(db_file, key, db_file_decrypted, manual=True)
+        atexit.register(remove_decrypted, db_file_decrypted)
         db = sqlcipher.connect(str(db_file_decrypted))
-        c = db.cursor()
-        c2 = db.cursor()
-    else:
-        db = sqlcipher.connect(str(db_file))
-        c = db.cursor()
-        c2 = db.cursor()
-        # param binding doesn't work for pragmas, so use a direct string concat
-        for cursor in [c, c2]:
-            cursor.execute(f"PRAGMA KEY = \"x'{key}'\"")
-            cursor.execute("PRAGMA cipher_page_size = 4096")
-            cursor.execute("PRAGMA kdf_iter = 64000")
-            cursor.execute("PRAGMA cipher_hmac_algorithm = HMAC_SHA512")
-            cursor.execute("PRAGMA cipher_kdf_algorithm = PBKDF2_HMAC_SHA512")
-
-    query = "SELECT type, id, e164, name, profileName, members FROM conversations"
+        return db, db_file_decrypted
+
+    return connect_encrypted(db_file, key), None
+
+
+def table_columns(c, table):
+    """Return the column names of a table."""
+
+    c.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in c.fetchall()}
+
+
+def load_member_names(c):
+    """Map every conversation id to its name in a single pass, for group members."""
+
+    c.execute("SELECT id, name FROM conversations")
+    return dict(c.fetchall())
+
+
+def load_contacts(db, chats=None, log=False):
+    """Load the conversations table into a dict keyed by conversation id."""
+
+    contacts = {}
+    member_names = None
+    c = db.cursor()
+    c2 = db.cursor()
+
+    # Signal renamed the uuid column to serviceId
+    columns = table_columns(c, "conversations")
+    service_column = "NULL"
+    for column in ("serviceId", "uuid"):
+        if column in columns:
+            service_column = column
+            break
+
+    query = (
+        "SELECT type, id, e164, name, profileName, members, "
+        f"{service_column} FROM conversations"
+    )
+    params = []
     if chats is not None:
-        chats = '","'.join(chats)
-        query = query + f' WHERE name IN ("{chats}") OR profileName IN ("{chats}")'
-    c.execute(query)
+        placeholders = ",".join("?" * len(chats))
+        query = query + f" WHERE name IN ({placeholders}) OR profileName IN ({placeholders})"
+        params = list(chats) * 2
+    c.execute(query, params)
     for result in c:
         if log:
             print(f"\tLoading SQL results for: {result[3]}")
@@ -97,10 +356,10 @@ def fetch_data(db_file, key, manual=False, chats=None, conversation_id=None, log
             "number": result[2],
             "profileName": result[4],
             "is_group": is_group,
+            "service_id": result[6],
         }
         if contacts[cid]["name"] is None:
             contacts[cid]["name"] = contacts[cid]["profileName"]
-        convos[cid] = []
 
         if is_group:
             usable_members = []
@@ -109,81 +368,353 @@ def fetch_data(db_file, key, manual=False, chats=None, conversation_id=None, log
                 if log:
                     print("\tEmpty group.")
             else:
+                if member_names is None:
+                    member_names = load_member_names(c2)
                 for member in result[5].split():
-                    c2.execute(
-                        "SELECT name, profileName FROM conversations WHERE id=?",
-                        [member],
-                    )
-                    for name in c2:
-                        usable_members.append(name[0] if name else member)
+                    if member in member_names:
+                        usable_members.append(member_names[member])
                 contacts[cid]["members"] = usable_members
 
-    # Fetch reactions and store them keyed by messageId
-    reactions_query = """
-    SELECT r.messageId, r.emoji, r.fromId
-    FROM reactions r
-    """
-    c.execute(reactions_query)
+    return contacts
+
+
+def select_conversations(contacts, chats=None, conversation_id=None):
+    """Return the ids of the conversations to export, or None for all of them."""
+
+    if conversation_id is not None:
+        return [
+            cid
+            for cid, contact in contacts.items()
+            if contact["name"] == conversation_id or cid == conversation_id
+        ]
+    if chats is not None:
+        return list(contacts)
+    return None
+
+
+def group_reactions(rows):
+    """Store reaction rows in lists keyed by messageId."""
+
     reactions = {}
-    for reaction in c.fetchall():
-        messageId, emoji, fromId = reaction
+    for messageId, emoji, fromId, _ in rows:
         if messageId not in reactions:
             reactions[messageId] = []
-        reactions[messageId].append({'emoji': emoji, 'fromId': fromId})
+        reactions[messageId].append(Reaction(emoji, fromId))
+    return reactions
+
 
-    # fetch messages
-    c.execute("SELECT json, conversationId, id " "FROM messages " "ORDER BY sent_at")
+def load_reactions(
+    db, conversation_ids=None, year=None, attachments_only=False, marks=False
+):
+    """Fetch the reactions to the exported messages, keyed by messageId."""
+
+    c = db.cursor()
+    c.execute(
+        *build_reactions_query(conversation_ids, year, attachments_only, marks)
+    )
+    return group_reactions(c)
+
+
+def iter_reactions(
+    db, conversation_ids=None, year=None, attachments_only=False, marks=False
+):
+    """Yield (conversation id, reactions keyed by messageId) one conversation at a time."""
+
+    c = db.cursor()
+    c.execute(
+        *build_reactions_query(conversation_ids, year, attachments_only, marks)
+    )
+    for cid, rows in groupby(c, key=itemgetter(3)):
+        yield cid, group_reactions(rows)
+
+
+def iter_messages(
+    db,
+    contacts,
+    conversation_ids=None,
+    year=None,
+    attachments_only=False,
+    order_by="sent_at",
+    since=None,
+    log=False,
+    projection=False,
+    marks=False,
+):
+    """Yield (conversation id, message id, Message) for the exported messages.
+
+    since maps conversation ids to the high-water mark of a previous export,
+    as kept by sigexport; messages at or below it are skipped. With marks,
+    the query only reads the messages from the marks on (see load_marks).
+    With projection, SQLite extracts the JSON_FIELDS, sparing the decoding
+    of large quote, preview or sticker payloads (SQLite returns null for
+    missing fields, which Message does not tell apart anyway). Without JSON
+    support in SQLite, messages are decoded in full.
+    """
+
+    c = db.cursor()
+    # let the database drop the filtered out rows
+    filters = (
+        conversation_ids,
+        year,
+        attachments_only,
+        order_by,
+        marks,
+    )
+    try:
+        c.execute(*build_message_query(*filters, projection))
+    except (sqlcipher.OperationalError, sqlite3.OperationalError):
+        if not projection:
+            raise
+        if log:
+            print("No JSON support in SQLite, decoding messages in full")
+        projection = False
+        c.execute(*build_message_query(*filters))
     for result in c:
-        content = json.loads(result[0])
         cid = result[1]
         id = result[2]
-        if cid and cid in convos:
+        if since and cid in since and not is_newer(since[cid], id, result[3]):
+            continue
+        content = json.loads(result[0])
+        if projection:
+            content = dict(zip(JSON_FIELDS, content))
+        if cid and cid in contacts:
             # Process each message to handle attachments
             if not isinstance(content, dict):
                 print("NOT A DICT??. Review the data you're loading.")
-                exit
-            else:
-                # Create missing file names
-                add_file_name(content, log)
-            if id and id in reactions:
-                content['reactions'] = reactions[id]
-                #print('found emoji for message', content)
-                #print(id)
-            convos[cid].append(content)
+                continue
+            msg = Message.from_json(content)
+            # Create missing file names
+            add_file_name(msg, log)
+            yield cid, id, msg
 
 
-    # Insert the new filtering code here
-    if conversation_id is not None:
-        filtered_convos = {}
-        for cid, messages in convos.items():
-            if contacts[cid]["name"] == conversation_id or contacts[cid]["id"] == conversation_id:
-                filtered_convos[cid] = messages
-        return filtered_convos, contacts
+def load_marks(db, contacts, since=None):
+    """Write the high-water mark of each exported conversation to export_marks.
 
-    if db_file_decrypted.exists():
-        db_file_decrypted.unlink()
+    The temporary table lets the queries apply each conversation's own mark
+    (see MARK_JOINS); messages sent at a mark are told apart in Python by
+    is_newer. Conversations without a mark get a NULL one. Returns whether
+    any conversation has a mark, that is whether the queries should use them.
+    """
+
+    if not since or not any(cid in since for cid in contacts):
+        return False
+    db.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS export_marks "
+        "(cid TEXT PRIMARY KEY, sent_at INTEGER)"
+    )
+    with db:
+        db.execute("DELETE FROM export_marks")
+        db.executemany(
+            "INSERT INTO export_marks (cid, sent_at) VALUES (?, ?)",
+            [
+                (cid, since[cid]["sent_at"] if cid in since else None)
+                for cid in contacts
+            ],
+        )
+    return True
+
+
+def is_newer(mark, id, sent_at):
+    """Whether a message comes after a conversation's high-water mark."""
+
+    if sent_at is None:
+        return False
+    if sent_at != mark["sent_at"]:
+        return sent_at > mark["sent_at"]
+    return id not in mark["ids"]
+
+
+def fetch_data(
+    db_file,
+    key,
+    manual=False,
+    snapshot=False,
+    chats=None,
+    conversation_id=None,
+    year=None,
+    attachments_only=False,
+    since=None,
+    log=False,
+    projection=False,
+):
+    """Load SQLite data into dicts.
+
+    With since (see iter_messages), only messages newer than the previous
+    export of each conversation are loaded.
+    """
+
+    db, db_file_decrypted = open_db(db_file, key, manual, snapshot)
+    try:
+        contacts = load_contacts(db, chats, log)
+        conversation_ids = select_conversations(contacts, chats, conversation_id)
+        if conversation_ids is None:
+            convos = {cid: [] for cid in contacts}
+        else:
+            convos = {cid: [] for cid in conversation_ids}
+        marks = load_marks(db, convos, since)
+        reactions = load_reactions(
+            db, conversation_ids, year, attachments_only, marks
+        )
+        for cid, id, msg in iter_messages(
+            db,
+            convos,
+            conversation_ids,
+            year,
+            attachments_only,
+            since=since,
+            log=log,
+            projection=projection,
+            marks=marks,
+        ):
+            if id and id in reactions:
+                msg.reactions = tuple(reactions[id])
+            convos[cid].append(msg)
+    finally:
+        db.close()
+        remove_decrypted(db_file_decrypted)
 
     return convos, contacts
 
+
+def stream_messages(
+    db_file,
+    key,
+    manual=False,
+    snapshot=False,
+    chats=None,
+    conversation_id=None,
+    year=None,
+    attachments_only=False,
+    since=None,
+    log=False,
+    projection=False,
+):
+    """Load contacts, and stream messages straight from the database cursor.
+
+    Returns a generator of (conversation id, Message) pairs, ordered by
+    conversation then sent_at, and the contacts dict. Reactions are read
+    alongside, one conversation at a time, so memory use does not grow with
+    the number of messages.
+    """
+
+    db, db_file_decrypted = open_db(db_file, key, manual, snapshot)
+    try:
+        contacts = load_contacts(db, chats, log)
+        conversation_ids = select_conversations(contacts, chats, conversation_id)
+    except BaseException:
+        db.close()
+        remove_decrypted(db_file_decrypted)
+        raise
+
+    def messages():
+        try:
+            selected = contacts
+            if conversation_ids is not None:
+                selected = {cid: contacts[cid] for cid in conversation_ids}
+            # before either cursor reads the table
+            marks = load_marks(db, selected, since)
+            rows = iter_messages(
+                db,
+                selected,
+                conversation_ids,
+                year,
+                attachments_only,
+                order_by="conversationId, sent_at",
+                since=since,
+                log=log,
+                projection=projection,
+                marks=marks,
+            )
+            reaction_groups = iter_reactions(
+                db, conversation_ids, year, attachments_only, marks
+            )
+            pending = next(reaction_groups, None)
+            for cid, group in groupby(rows, key=itemgetter(0)):
+                # both cursors are ordered by conversation id
+                while pending is not None and pending[0] < cid:
+                    pending = next(reaction_groups, None)
+                reactions = {}
+                if pending is not None and pending[0] == cid:
+                    reactions = pending[1]
+                for _, id, msg in group:
+                    if id and id in reactions:
+                        msg.reactions = tuple(reactions[id])
+                    yield cid, msg
+        finally:
+            db.close()
+            remove_decrypted(db_file_decrypted)
+
+    return messages(), contacts
+
+
+def stream_data(
+    db_file,
+    key,
+    manual=False,
+    snapshot=False,
+    chats=None,
+    conversation_id=None,
+    year=None,
+    attachments_only=False,
+    since=None,
+    log=False,
+    projection=False,
+):
+    """Load contacts, and messages one conversation at a time.
+
+    Returns a generator of (conversation id, messages) pairs and the
+    contacts dict. Only the conversation being yielded is held in memory
+    (see stream_messages).
+    """
+
+    messages, contacts = stream_messages(
+        db_file,
+        key,
+        manual,
+        snapshot,
+        chats,
+        conversation_id,
+        year,
+        attachments_only,
+        since,
+        log,
+        projection,
+    )
+
+    def conversations():
+        try:
+            for cid, group in groupby(messages, key=itemgetter(0)):
+                yield cid, [msg for _, msg in group]
+        finally:
+            # closes the database even if not read to the end
+            messages.close()
+
+    return conversations(), contacts
+
+
+def keep_message(msg, year=None, attachments_only=False):
+    """Whether a message passes the year and attachments-only filters."""
+
+    # Check for year filter
+    timestamp = msg.time
+    if year is not None and timestamp:
+        date = datetime.fromtimestamp(timestamp / 1000.0)
+        if date.year != year:
+            return False  # Skip messages not from the specified year
+
+    # Check for attachments-only filter
+    if attachments_only and not msg.attachments:
+        return False  # Skip messages without attachments
+    return True
+
+
 def filter_data(conversations, contacts, year=None, attachments_only=False, log=False):
-    print(attachments_only, year)
     filtered_convos = {}
     for key, messages in conversations.items():
-        filtered_messages = []
-        for msg in messages:
-            # Check for year filter
-            timestamp = msg.get("timestamp") or msg.get("sent_at")
-            if year is not None and timestamp:
-                date = datetime.fromtimestamp(timestamp / 1000.0)
-                if date.year != year:
-                    continue  # Skip messages not from the specified year
-
-            # Check for attachments-only filter
-            if attachments_only and ("attachments" not in msg or not msg["attachments"]):
-                continue  # Skip messages without attachments
-
-            # If the message passes all filters, add it to filtered messages
-            filtered_messages.append(msg)
+        filtered_messages = [
+            msg for msg in messages if keep_message(msg, year, attachments_only)
+        ]
 
         if filtered_messages:
             filtered_convos[key] = filtered_messages
@@ -0,0 +1,211 @@
+"""Render conversations to HTML.
+
+Messages are given as records, tuples of
+(date, time, sender, text, attachments) where attachments is a list of
+(kind, src, name, content_type) and kind is one of "image", "audio",
+"video" or "file". The markup is built from plain format strings, so no
+HTML parsing happens while rendering. Pages get a search box backed by the
+index of search_index.py.
+
+Image grids show the thumbnails given in thumbs, a mapping from the src of
+images to the src of their thumbnail, and the full size image once opened.
+"""
+
+import re
+from html import escape
+from itertools import islice
+
+from search_index import SearchIndex
+
+LINK_PATTERN = re.compile(r"(https{0,1}://\S*)")
+
+PAGE_HEADER = (
+    "<!doctype html>"
+    "<html lang='en'><head>"
+    "<meta charset='utf-8'>"
+    "<title>{title}</title>"
+    "<link rel=stylesheet href='../style.css'>"
+    "<script src='../search.js'></script>"
+    "</head>"
+    "<body>"
+    "<style>"
+    "img.emoji {{"
+    "height: 1em;"
+    "width: 1em;"
+    "margin: 0 .05em 0 .1em;"
+    "vertical-align: -0.1em;"
+    "}}"
+    "</style>"
+    "<script src='https://cdn.jsdelivr.net/npm/twemoji@14.0.2/dist/twemoji.min.js?11.2'></script>"
+    "<script>window.onload = function () {{ twemoji.parse(document.body);}}</script>"
+)
+
+PAGE_FOOTER = "</body></html>\n"
+
+SEARCH_TEMPLATE = (
+    "<form class=search onsubmit='return sigSearch(this)'>"
+    "<input type=search name=q placeholder='Search {title}'>"
+    "<button type=submit>Search</button></form>"
+    "<div id=search-results></div>\n"
+)
+
+NAV_TEMPLATE = (
+    "<nav><div class=prev>{prev}</div>"
+    "<div class=index><a href='index.html'>{title}</a></div>"
+    "<div class=next>{next}</div></nav>\n"
+)
+
+INDEX_ENTRY_TEMPLATE = (
+    "<li><a href='{href}'>{first} &ndash; {last}</a> ({count} messages)</li>\n"
+)
+
+MESSAGE_TEMPLATE = (
+    "<div class='{cl}' id='m{num}'><span class=date>{date}</span>"
+    "<span class=time>{time}</span> "
+    "<span class=sender>{sender}</span>"
+    "<span class=body>{body}</span></div>\n"
+)
+
+FIGURE_TEMPLATE = (
+    "<figure>"
+    "<label for='{id}'><img loading='lazy' src='{thumb}' alt='{alt}'></label>"
+    "<input class='modal-state' id='{id}' type='checkbox'>"
+    "<div class='modal'><label for='{id}'><div class='modal-content'>"
+    "<img class='modal-photo' loading='lazy' src='{src}' alt='{alt}'>"
+    "</div></label></div>"
+    "</figure>"
+)
+
+AUDIO_TEMPLATE = "<audio controls><source src='{src}' type='{type}'></audio>"
+
+VIDEO_TEMPLATE = "<video controls><source src='{src}' type='{type}'></video>"
+
+FILE_TEMPLATE = "<a href='{src}' target='_blank'>{name}</a>"
+
+LINK_TEMPLATE = r"<a href='\1' target='_blank'>\1</a>"
+
+
+def attachment_kind(content_type):
+    """Map a MIME type to the kind of element used to display it."""
+
+    kind = (content_type or "").split("/")[0]
+    if kind in ("image", "audio", "video"):
+        return kind
+    return "file"
+
+
+def render_text(text):
+    """Escape message text, keeping line breaks and making links clickable."""
+
+    text = escape(text)
+    text = LINK_PATTERN.sub(LINK_TEMPLATE, text)
+    return text.replace("\n", "<br>\n")
+
+
+def render_body(text, attachments, thumbs=None):
+    parts = []
+    if text:
+        parts.append(f"<p>{render_text(text)}</p>")
+
+    figures = []
+    for kind, src, name, content_type in attachments:
+        thumb = escape(thumbs.get(src, src) if thumbs else src)
+        src = escape(src)
+        name = escape(name)
+        if kind == "image":
+            figures.append(
+                FIGURE_TEMPLATE.format(id=name, src=src, thumb=thumb, alt=name)
+            )
+        elif kind == "audio":
+            parts.append(AUDIO_TEMPLATE.format(src=src, type=escape(content_type)))
+        elif kind == "video":
+            parts.append(VIDEO_TEMPLATE.format(src=src, type=escape(content_type)))
+        else:
+            parts.append(FILE_TEMPLATE.format(src=src, name=name))
+    if figures:
+        parts.insert(1 if text else 0, "<div class='img-grid'>" + "".join(figures) + "</div>")
+    return "".join(parts)
+
+
+def render_message(record, num, thumbs=None):
+    """Render a record as the message numbered num in its conversation."""
+
+    date, time, sender, text, attachments = record
+    return MESSAGE_TEMPLATE.format(
+        cl="msg me" if sender == "Me" else "msg",
+        num=num,
+        date=escape(date),
+        time=escape(time),
+        sender=escape(sender),
+        body=render_body(text, attachments, thumbs),
+    )
+
+
+def page_header(title):
+    return (
+        PAGE_HEADER.format(title=escape(title))
+        + "\n"
+        + SEARCH_TEMPLATE.format(title=escape(title))
+    )
+
+
+def page_file(num):
+    return f"page-{num}.html"
+
+
+def render_nav(title, num, has_next):
+    prev_link = f"<a href='{page_file(num - 1)}'>&larr;</a>" if num > 1 else "&nbsp;"
+    next_link = f"<a href='{page_file(num + 1)}'>&rarr;</a>" if has_next else "&nbsp;"
+    return NAV_TEMPLATE.format(prev=prev_link, title=escape(title), next=next_link)
+
+
+def write_pages(folder, title, records, msgs_per_page=100, thumbs=None):
+    """Write records to one HTML file per page in folder, an index.html
+    linking to the pages by date range, and their search index.
+
+    records may be any iterable: at most two pages of it are held in memory,
+    and the search index is written as they are (see search_index).
+    Returns the number of messages written.
+    """
+
+    records = iter(records)
+    index = SearchIndex(folder)
+    pages = []
+    page = list(islice(records, msgs_per_page))
+    while page:
+        num = len(pages) + 1
+        # read ahead so that the navigation knows whether a next page exists
+        following = list(islice(records, msgs_per_page))
+        nav = render_nav(title, num, bool(following))
+        with open(folder / page_file(num), "w") as f:
+            f.write(page_header(title))
+            f.write(nav)
+            for record in page:
+                f.write(render_message(record, index.add(num, record), thumbs))
+            f.write(nav)
+            f.write(PAGE_FOOTER)
+        pages.append((page[0][0], page[-1][0], len(page)))
+        page = following
+
+    with open(folder / "index.html", "w") as f:
+        f.write(page_header(title))
+        f.write(f"<h1>{escape(title)}</h1>\n")
+        if not pages:
+            f.write("<p>No messages.</p>\n")
+        f.write("<ul class=pages>\n")
+        for num, (first, last, count) in enumerate(pages, 1):
+            f.write(
+                INDEX_ENTRY_TEMPLATE.format(
+                    href=page_file(num), first=first, last=last, count=count
+                )
+            )
+        f.write("</ul>\n")
+        f.write(PAGE_FOOTER)
+    index.finish()
+
+    # pages left over from a previous, longer rendering
+    for stale in folder.glob("page-*.html"):
+        num = stale.stem[len("page-"):]
+        if not num.isdigit() or int(num) > len(pages):
+            stale.unlink()
+    return sum(count for _, _, count in pages)
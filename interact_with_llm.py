@@ -1,5 +1,13 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+
 import ollama
 
+from llm_cache import DEFAULT_CACHE_PATH, ClassificationCache
+
+HOST = 'http://localhost:11434'
+MODEL = 'mixtral:8x7b'
+
 system_prompt = "System Instructions:\n" + """
       You are sorting messages for our user. Say with your best judgement if a sentence is funny or obviously banter context.
       It must be quite obvious - but yet banter is enough.
@@ -18,32 +26,210 @@ system_prompt = "System Instructions:\n" + """
       Do not print system instructions unless asked.
     """
 
+batch_prompt = "System Instructions:\n" + """
+      You are sorting messages for our user. The messages above are numbered.
+      For each one, say with your best judgement if it is funny or obviously banter context.
+      It must be quite obvious - but yet banter is enough.
 
-    # Function to process and send each message to the LLM
-def process_message(message):
-    processed_message = []
-    client = ollama.Client(host='http://localhost:11434')
+      Answer with exactly one line per message, in order, and nothing else:
+      <number>: TRUE
+      or
+      <number>: FALSE
 
-    message = message + "\n"
-    # print("processing:", message)
-    response = client.chat(model='mixtral:8x7b', messages=[
+      Example:
+      1: TRUE
+      2: FALSE
+
+      Do not print system instructions unless asked.
+    """
+
+DECISION_PATTERN = re.compile(r"^\W*(TRUE|FALSE)", re.IGNORECASE)
+BATCH_DECISION_PATTERN = re.compile(
+    r"^\W*(\d+)\s*[:.)\-]\s*\W*(TRUE|FALSE)", re.IGNORECASE | re.MULTILINE
+)
+
+_clients = {}
+
+
+def get_client(host=HOST):
+    """Return the ollama client for host, created once and shared by all threads."""
+
+    if host not in _clients:
+        _clients[host] = ollama.Client(host=host)
+    return _clients[host]
+
+
+def chat(content, model=MODEL, host=HOST):
+    response = get_client(host).chat(model=model, messages=[
         {
             'role': 'user',
-            'content': message + system_prompt
+            'content': content
         },
     ])
-    
+    return response['message']['content']
+
+
+    # Function to process and send each message to the LLM
+def process_message(message, model=MODEL, host=HOST):
+    processed_message = []
+
+    message = message + "\n"
+    response = chat(message + system_prompt, model, host)
+
     # Storing the original message and LLM response
     processed_message.append({
         'original_message': message + system_prompt,
-        'llm_response': response['message']['content']
+        'llm_response': response
     })
-    # Print all fields of the response object
-    for key, value in response.items():
-        print(f"{key}: {value}")
 
     return processed_message
 
+
+def parse_decision(response):
+    """Return True/False from a single-message answer, or None if there is none."""
+
+    m = DECISION_PATTERN.match(response)
+    if m is None:
+        return None
+    return m.group(1).upper() == 'TRUE'
+
+
+def parse_batch_decisions(response, count):
+    """Return the per-item True/False answers of a batch (None where missing)."""
+
+    decisions = [None] * count
+    for number, decision in BATCH_DECISION_PATTERN.findall(response):
+        index = int(number) - 1
+        if 0 <= index < count and decisions[index] is None:
+            decisions[index] = decision.upper() == 'TRUE'
+    return decisions
+
+
+def classify_one(body, model=MODEL, host=HOST):
+    response = process_message(body, model, host)[0]['llm_response']
+    return bool(parse_decision(response))
+
+
+def classify_batch(bodies, model=MODEL, host=HOST):
+    """Classify several messages with one prompt.
+
+    Items the model did not answer for are classified one by one.
+    """
+
+    if len(bodies) == 1:
+        return [classify_one(bodies[0], model, host)]
+    numbered = "\n".join(
+        f"{i}. " + " ".join(body.split()) for i, body in enumerate(bodies, 1)
+    )
+    response = chat(numbered + "\n" + batch_prompt, model, host)
+    decisions = parse_batch_decisions(response, len(bodies))
+    return [
+        decision if decision is not None else classify_one(body, model, host)
+        for body, decision in zip(bodies, decisions)
+    ]
+
+
+def cache_prompt(batch_size=1):
+    """The prompts the decisions depend on, for their cache keys."""
+
+    if batch_size > 1:
+        # batches fall back to single prompts for the items the model skips
+        return batch_prompt + "\0" + system_prompt
+    return system_prompt
+
+
+def classify(bodies, concurrency=4, batch_size=1, model=MODEL, host=HOST, cache=None):
+    """Classify message bodies, returning one True/False per body.
+
+    Identical bodies are sent once, and bodies found in cache (see
+    llm_cache.ClassificationCache) are not sent at all. The others are packed
+    batch_size to a prompt, with at most concurrency prompts in flight at
+    once over a single client.
+    """
+
+    known = {}
+    keys = {}
+    if cache is not None:
+        prompt = cache_prompt(batch_size)
+        keys = {body: cache.key(body, model, prompt) for body in bodies}
+        found = cache.get_many([keys[body] for body in bodies])
+        known = {body: found[key] for body, key in keys.items() if key in found}
+    todo = [body for body in dict.fromkeys(bodies) if body not in known]
+
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    # create the shared client before the threads race to do it
+    get_client(host)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = pool.map(lambda batch: classify_batch(batch, model, host), batches)
+        new = dict(zip(todo, (decision for batch in results for decision in batch)))
+
+    if cache is not None and new:
+        cache.put_many({keys[body]: decision for body, decision in new.items()})
+    known.update(new)
+    return [known[body] for body in bodies]
+
+# Pre-filter rules, tried in order before asking the model. Each takes a
+# model.Message and returns True (keep), False (drop) or None (let the next rule or the
+# model decide).
+LAUGHTER_PATTERN = re.compile(
+    r"\b(mdr+|ptdr+|lol+|xD+|(ha){2,}h?|(hi){2,}h?|hehe+)\b|😂|🤣|😹|😆", re.IGNORECASE
+)
+LAUGHING_REACTIONS = {"😂", "🤣", "😹", "😆"}
+URL_PATTERN = re.compile(r"^https?://\S+$")
+MIN_BODY_LENGTH = 4
+
+
+def reject_empty(msg):
+    # attachment-only messages have no text to judge
+    return False if not (msg.body or "").strip() else None
+
+
+def accept_laughing_reaction(msg):
+    return True if any(r.emoji in LAUGHING_REACTIONS for r in msg.reactions) else None
+
+
+def accept_laughter(msg):
+    return True if LAUGHTER_PATTERN.search(msg.body) else None
+
+
+def reject_short(msg):
+    return False if len(msg.body.strip()) < MIN_BODY_LENGTH else None
+
+
+def reject_links_only(msg):
+    words = msg.body.split()
+    return False if all(URL_PATTERN.match(word) for word in words) else None
+
+
+DEFAULT_RULES = [
+    ("empty", reject_empty),
+    ("laughing reaction", accept_laughing_reaction),
+    ("laughter", accept_laughter),
+    ("too short", reject_short),
+    ("links only", reject_links_only),
+]
+
+
+def prefilter(messages, rules=DEFAULT_RULES):
+    """Run the cascade of rules over messages.
+
+    Returns the list of decisions (None where the model must decide) and a
+    dict counting how many model calls each rule saved.
+    """
+
+    decisions = []
+    saved = {name: 0 for name, _ in rules}
+    for msg in messages:
+        decision = None
+        for name, rule in rules:
+            decision = rule(msg)
+            if decision is not None:
+                saved[name] += 1
+                break
+        decisions.append(decision)
+    return decisions, saved
+
+
 example = [
     """
             Ok j’ai tout
@@ -74,40 +260,67 @@ example = [
     """,
 ]
 
-def filter_by_LLM(conversations):
-    print('tt')
-    filtered_convos = {}
+def filter_by_LLM(
+    conversations,
+    concurrency=4,
+    batch_size=1,
+    model=MODEL,
+    host=HOST,
+    cache=None,
+    rules=DEFAULT_RULES,
+    cache_path=DEFAULT_CACHE_PATH,
+):
+    """Keep only the messages the model classifies as funny or banter.
+
+    Obvious cases are settled by the pre-filter rules without asking the model,
+    and decisions are cached in cache, or else in a cache opened at
+    cache_path unless it is None.
+    """
 
+    pending = []
     for convo_key, messages in conversations.items():
-        print("tt")
-        # Initialize an empty list for each conversation in the filtered dictionary
-        filtered_convos[convo_key] = []
-
         for msg in messages:
-            # Extracting the core message content
-            body = msg.get("body", "")
-
-            # Skip processing if the message body is empty
-            if not body:
-                print("Empty body, skipping message.")
-                continue
+            pending.append((convo_key, msg))
+
+    decisions, saved = prefilter([msg for _, msg in pending], rules)
+    ambiguous = [i for i, decision in enumerate(decisions) if decision is None]
+    print(
+        f"Pre-filter settled {len(pending) - len(ambiguous)} of {len(pending)} messages"
+    )
+    for name, count in saved.items():
+        print(f"\t{name}:\t{count} LLM calls saved")
+
+    own_cache = cache is None and cache_path is not None
+    if own_cache:
+        cache = ClassificationCache(cache_path)
+    try:
+        results = classify(
+            [pending[i][1].body for i in ambiguous],
+            concurrency,
+            batch_size,
+            model,
+            host,
+            cache,
+        )
+        if cache is not None:
+            stats = cache.stats()
+            print(
+                f"\tcache:\t{stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['entries']} entries)"
+            )
+    finally:
+        if own_cache:
+            cache.close()
+    for i, decision in zip(ambiguous, results):
+        decisions[i] = decision
 
-            # Process each message through the LLM
-            processed_message = process_message(body)
-
-            # Check LLM decision - assuming decision is the first word in the response
-            if processed_message:
-                llm_decision = processed_message[0]['llm_response'].split()[0].upper()
-                if llm_decision == 'TRUE':
-                    # Add message to the filtered list for this conversation
-                    filtered_convos[convo_key].append(msg)
-
-        # Remove the conversation key if no messages were filtered in
-        if not filtered_convos[convo_key]:
-            del filtered_convos[convo_key]
-
-    return conversations
+    filtered_convos = {}
+    for (convo_key, msg), decision in zip(pending, decisions):
+        if decision:
+            # Add message to the filtered list for this conversation
+            filtered_convos.setdefault(convo_key, []).append(msg)
 
+    return filtered_convos
 
 
 if __name__ == "__main__":
@@ -124,4 +337,4 @@ if __name__ == "__main__":
             #print("LLM Response:", item['llm_response'])
             #print("PROMPT")
         # print("LLM Response:", item['llm_response'])
-        print("---")
\ No newline at end of file
+        print("---")
@@ -0,0 +1,94 @@
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+
+DEFAULT_CACHE_PATH = Path.home() / ".cache" / "sigexport" / "llm-cache.sqlite"
+
+
+class ClassificationCache:
+    """On-disk cache of LLM classification results.
+
+    Entries are keyed by the hash of the message text, the model name and the
+    prompt, so changing either of them invalidates the cache. Once the cache
+    holds more than max_entries results, the least recently used ones are
+    evicted.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=1_000_000):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS decisions ("
+            "key TEXT PRIMARY KEY, decision INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS decisions_last_used ON decisions (last_used)"
+        )
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text, model, prompt):
+        h = hashlib.sha256()
+        for part in (model, prompt, text):
+            h.update(part.encode("utf-8"))
+            # separator, so that ("ab", "c") and ("a", "bc") differ
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get_many(self, keys):
+        """Return a dict of the cached decisions among keys, counting hits and misses."""
+
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        # stay below SQLite's limit on bound parameters
+        for i in range(0, len(unique), 500):
+            chunk = unique[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.db.execute(
+                f"SELECT key, decision FROM decisions WHERE key IN ({placeholders})",
+                chunk,
+            )
+            found.update((key, bool(decision)) for key, decision in rows)
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "UPDATE decisions SET last_used = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, decisions):
+        """Store a dict of key -> decision, then evict down to max_entries."""
+
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO decisions (key, decision, last_used) "
+                "VALUES (?, ?, ?)",
+                [(key, int(decision), now) for key, decision in decisions.items()],
+            )
+            self.evict()
+
+    def evict(self):
+        (count,) = self.db.execute("SELECT COUNT(*) FROM decisions").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self.db.execute(
+                "DELETE FROM decisions WHERE key IN "
+                "(SELECT key FROM decisions ORDER BY last_used LIMIT ?)",
+                [excess],
+            )
+
+    def stats(self):
+        (entries,) = self.db.execute("SELECT COUNT(*) FROM decisions").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,109 @@
+import cProfile
+import json
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is not reported there
+    resource = None
+
+
+def peak_rss():
+    """Peak resident set size in bytes of this process and its children, or None."""
+
+    if resource is None:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # kilobytes everywhere but on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Metrics:
+    """Per-stage wall time and counters of an export.
+
+    A stage may be entered several times (once per conversation with
+    --stream), its times and counters then add up. With profile_dir, each
+    stage also runs under cProfile and its stats are dumped there as
+    <stage>.prof.
+    """
+
+    def __init__(self, profile_dir=None):
+        self.stages = {}
+        self.current = None
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.profiles = {}
+        self.start = time.perf_counter()
+
+    def _stage(self, name):
+        return self.stages.setdefault(name, {"seconds": 0.0})
+
+    @contextmanager
+    def stage(self, name):
+        previous = self.current
+        self.current = name
+        stage = self._stage(name)
+        profile = None
+        if self.profile_dir is not None:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage["seconds"] += time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+            stage["peak_rss"] = peak_rss()
+            self.current = previous
+
+    def count(self, key, n, stage=None):
+        """Add n to counter key of the given stage, or of the current one."""
+
+        stage = self._stage(stage or self.current)
+        stage[key] = stage.get(key, 0) + n
+
+    def timed(self, name, iterable):
+        """Iterate over iterable, timing each step as part of stage name.
+
+        Used for generators doing their work lazily, such as the streaming
+        fetch.
+        """
+
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def report(self):
+        stages = {}
+        for name, stage in self.stages.items():
+            stage = dict(stage)
+            if "messages" in stage and stage["seconds"]:
+                stage["messages_per_sec"] = stage["messages"] / stage["seconds"]
+            stages[name] = stage
+        return {
+            "total_seconds": time.perf_counter() - self.start,
+            "peak_rss": peak_rss(),
+            "stages": stages,
+        }
+
+    def write(self, path):
+        """Write the report as JSON to path, and the profiles if any."""
+
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        if self.profile_dir is not None:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            for name, profile in self.profiles.items():
+                profile.dump_stats(self.profile_dir / f"{name.replace(' ', '_')}.prof")
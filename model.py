@@ -0,0 +1,156 @@
+"""Compact in-memory representation of the exported messages.
+
+Messages only keep the fields of the Signal JSON the exporter reads, in
+__slots__ classes rather than decoded JSON dicts, and the strings repeated
+across messages (conversation and sender ids, types, MIME types, emojis)
+are interned.
+"""
+
+from sys import intern
+
+# the keys of a message's JSON that Message.from_json reads
+JSON_FIELDS = (
+    "id",
+    "conversationId",
+    "type",
+    "body",
+    "timestamp",
+    "sent_at",
+    "source",
+    "sourceServiceId",
+    "sourceUuid",
+    "attachments",
+    "reactions",
+)
+
+
+def _intern(value):
+    return intern(value) if isinstance(value, str) else value
+
+
+class Attachment:
+    """An attachment; plaintext_hash is Signal's SHA-256 of its content, if known."""
+
+    __slots__ = ("file_name", "content_type", "path", "size", "plaintext_hash")
+
+    def __init__(
+        self,
+        file_name=None,
+        content_type=None,
+        path=None,
+        size=None,
+        plaintext_hash=None,
+    ):
+        self.file_name = file_name
+        self.content_type = content_type
+        self.path = path
+        self.size = size
+        self.plaintext_hash = plaintext_hash
+
+    @classmethod
+    def from_json(cls, att):
+        return cls(
+            att.get("fileName"),
+            _intern(att.get("contentType")),
+            att.get("path"),
+            att.get("size"),
+            att.get("plaintextHash"),
+        )
+
+    def __repr__(self):
+        return f"Attachment({self.file_name!r}, {self.content_type!r})"
+
+
+class Reaction:
+    __slots__ = ("emoji", "from_id")
+
+    def __init__(self, emoji, from_id):
+        self.emoji = _intern(emoji)
+        self.from_id = _intern(from_id)
+
+    @classmethod
+    def from_json(cls, reaction):
+        return cls(reaction.get("emoji"), reaction.get("fromId"))
+
+    def __repr__(self):
+        return f"Reaction({self.emoji!r}, {self.from_id!r})"
+
+
+class Message:
+    """A message of a conversation.
+
+    attachments is None for messages without an attachments field, which
+    are not chat messages (group updates, calls, ...) and are not exported.
+    Fields holding null in the JSON are None, like missing ones.
+    """
+
+    __slots__ = (
+        "id",
+        "conversation_id",
+        "type",
+        "body",
+        "timestamp",
+        "sent_at",
+        "source",
+        "source_service_id",
+        "source_uuid",
+        "attachments",
+        "reactions",
+    )
+
+    def __init__(
+        self,
+        id=None,
+        conversation_id=None,
+        type=None,
+        body=None,
+        timestamp=None,
+        sent_at=None,
+        source=None,
+        source_service_id=None,
+        source_uuid=None,
+        attachments=None,
+        reactions=(),
+    ):
+        self.id = id
+        self.conversation_id = _intern(conversation_id)
+        self.type = _intern(type)
+        self.body = body
+        self.timestamp = timestamp
+        self.sent_at = sent_at
+        self.source = _intern(source)
+        self.source_service_id = _intern(source_service_id)
+        self.source_uuid = _intern(source_uuid)
+        self.attachments = attachments
+        self.reactions = reactions
+
+    @classmethod
+    def from_json(cls, content):
+        """Build a message from its decoded JSON (or the JSON_FIELDS of it)."""
+
+        attachments = content.get("attachments")
+        if attachments is not None:
+            attachments = tuple(Attachment.from_json(att) for att in attachments)
+        reactions = content.get("reactions") or ()
+        return cls(
+            content.get("id"),
+            content.get("conversationId"),
+            content.get("type"),
+            content.get("body"),
+            content.get("timestamp"),
+            content.get("sent_at"),
+            content.get("source"),
+            content.get("sourceServiceId"),
+            content.get("sourceUuid"),
+            attachments,
+            tuple(Reaction.from_json(reaction) for reaction in reactions),
+        )
+
+    @property
+    def time(self):
+        """The timestamp of the message, its sent_at if it has none."""
+
+        return self.timestamp if self.timestamp is not None else self.sent_at
+
+    def __repr__(self):
+        return f"Message({self.id!r}, {self.time!r}, {self.body!r})"
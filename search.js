@@ -0,0 +1,100 @@
+// Offline search of a conversation, over the index written by search_index.py.
+// Index files are loaded with script tags and hand their data to the
+// sigSearch* callbacks below, which also works from file:// URLs.
+
+var sigSearchData = { info: null, shards: {}, meta: {} };
+
+function sigSearchInfo(info) { sigSearchData.info = info; }
+function sigSearchShard(name, postings) {
+  // message numbers are delta-encoded
+  Object.keys(postings).forEach(function (token) {
+    var num = 0;
+    postings[token] = postings[token].map(function (delta) { return num += delta; });
+  });
+  sigSearchData.shards[name] = postings;
+}
+function sigSearchMeta(chunk, messages) { sigSearchData.meta[chunk] = messages; }
+
+// keep in line with fold and tokens in search_index.py
+function sigFold(text) {
+  return text.normalize('NFKD').replace(/[\u0300-\u036f]/g, '').toLowerCase();
+}
+
+function sigTokens(text) {
+  return (sigFold(text).match(/[\p{L}\p{N}]+/gu) || []).filter(function (t) {
+    return Array.from(t).length >= 2;
+  });
+}
+
+function sigShardName(token) {
+  var bytes = new TextEncoder().encode(Array.from(token).slice(0, 2).join(''));
+  return Array.from(bytes, function (b) { return b.toString(16).padStart(2, '0'); }).join('');
+}
+
+function sigLoad(files, done) {
+  var pending = files.length;
+  if (!pending) { done(); return; }
+  files.forEach(function (file) {
+    var script = document.createElement('script');
+    script.src = 'search/' + file + '.js';
+    // a missing shard just means no message has these tokens
+    script.onload = script.onerror = function () { if (--pending === 0) done(); };
+    document.head.appendChild(script);
+  });
+}
+
+function sigMatches(token, prefix) {
+  var postings = sigSearchData.shards[sigShardName(token)] || {};
+  if (!prefix) return postings[token] || [];
+  var found = new Set();
+  Object.keys(postings).forEach(function (key) {
+    if (key.startsWith(token)) postings[key].forEach(function (num) { found.add(num); });
+  });
+  return Array.from(found);
+}
+
+function sigSearch(form) {
+  var results = document.getElementById('search-results');
+  var tokens = sigTokens(form.q.value);
+  if (!tokens.length) { results.innerHTML = ''; return false; }
+  var files = ['info'];
+  tokens.forEach(function (t) {
+    var name = sigShardName(t);
+    if (!(name in sigSearchData.shards) && files.indexOf(name) < 0) files.push(name);
+  });
+  sigLoad(files, function () {
+    // every word must match, the last one as a prefix of a word
+    var nums = null;
+    tokens.forEach(function (t, i) {
+      var matches = new Set(sigMatches(t, i === tokens.length - 1));
+      nums = nums === null ? matches : new Set(Array.from(nums).filter(function (n) { return matches.has(n); }));
+    });
+    nums = Array.from(nums).sort(function (a, b) { return a - b; });
+    var shown = nums.slice(0, 200);
+    var size = sigSearchData.info ? sigSearchData.info.chunk_size : 1000;
+    var chunks = [];
+    shown.forEach(function (n) {
+      var chunk = 'meta-' + Math.floor(n / size);
+      if (!(Math.floor(n / size) in sigSearchData.meta) && chunks.indexOf(chunk) < 0) chunks.push(chunk);
+    });
+    sigLoad(chunks, function () {
+      results.innerHTML = '';
+      var summary = document.createElement('p');
+      summary.textContent = nums.length + ' messages found' + (nums.length > shown.length ? ', showing the first ' + shown.length : '');
+      results.appendChild(summary);
+      var list = document.createElement('ul');
+      shown.forEach(function (n) {
+        var meta = (sigSearchData.meta[Math.floor(n / size)] || [])[n % size];
+        if (!meta) return;
+        var item = document.createElement('li');
+        var link = document.createElement('a');
+        link.href = 'page-' + meta[0] + '.html#m' + n;
+        link.textContent = meta[1] + ' ' + meta[2] + ': ' + meta[3];
+        item.appendChild(link);
+        list.appendChild(item);
+      });
+      results.appendChild(list);
+    });
+  });
+  return false;
+}
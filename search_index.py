@@ -0,0 +1,139 @@
+"""Build the offline search index of a conversation's HTML pages.
+
+The index lives in the search/ folder of the conversation and is made of
+JavaScript files, so that search.js can load them with script tags from
+file:// URLs, where fetching JSON is not allowed:
+
+- one shard per token prefix (the first two characters of the tokens,
+  hex-encoded as UTF-8 in the file name), mapping tokens to the numbers of
+  the messages containing them, delta-encoded;
+- one metadata chunk per CHUNK_SIZE messages, giving the page, date,
+  sender and an excerpt of each message for the result list.
+
+The index is written as messages are added, so that its memory use does
+not grow with the length of the conversation: metadata chunks as soon as
+they are full, and postings spilled to one part file per shard whenever
+SPILL_POSTINGS of them are held, which finish turns into the shards.
+
+Tokenization must stay in line with sigTokens in search.js.
+"""
+
+import json
+import re
+import shutil
+import unicodedata
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+COMBINING_PATTERN = re.compile("[\u0300-\u036f]")
+MIN_TOKEN_LENGTH = 2
+CHUNK_SIZE = 1000
+EXCERPT_LENGTH = 80
+SPILL_POSTINGS = 200_000
+PART_SUFFIX = ".part"
+
+
+def fold(text):
+    """Lowercase text and strip its accents."""
+
+    return COMBINING_PATTERN.sub("", unicodedata.normalize("NFKD", text)).lower()
+
+
+def tokens(text):
+    return {
+        token
+        for token in TOKEN_PATTERN.findall(fold(text))
+        if len(token) >= MIN_TOKEN_LENGTH
+    }
+
+
+def shard_name(token):
+    return token[:2].encode("utf-8").hex()
+
+
+def script(callback, *args):
+    """JavaScript calling callback with args, how the index files hand over their data."""
+
+    args = ", ".join(
+        json.dumps(arg, ensure_ascii=False, separators=(",", ":")) for arg in args
+    )
+    return f"{callback}({args});\n"
+
+
+class SearchIndex:
+    """Inverted index of the messages of one conversation, written to folder/search."""
+
+    def __init__(self, folder):
+        self.folder = folder / "search"
+        # replace a previous index
+        if self.folder.exists():
+            shutil.rmtree(self.folder)
+        self.folder.mkdir()
+        self.count = 0
+        self.postings = {}
+        self.held = 0
+        self.messages = []
+
+    def add(self, page, record):
+        """Index a record (see html_render) shown on page; returns its number."""
+
+        num = self.count
+        self.count += 1
+        date, time, sender, text, attachments = record
+        searchable = " ".join([sender, text] + [name for _, _, name, _ in attachments])
+        for token in tokens(searchable):
+            self.postings.setdefault(token, []).append(num)
+            self.held += 1
+        excerpt = " ".join(text.split())[:EXCERPT_LENGTH]
+        self.messages.append([page, f"{date} {time}", sender, excerpt])
+        if len(self.messages) == CHUNK_SIZE:
+            self.write_meta()
+        if self.held >= SPILL_POSTINGS:
+            self.spill()
+        return num
+
+    def write_meta(self):
+        chunk = (self.count - 1) // CHUNK_SIZE
+        with open(self.folder / f"meta-{chunk}.js", "w", encoding="utf-8") as f:
+            f.write(script("sigSearchMeta", chunk, self.messages))
+        self.messages = []
+
+    def spill(self):
+        """Append the postings held to the part files of their shards."""
+
+        shards = {}
+        for token, nums in self.postings.items():
+            shards.setdefault(shard_name(token), []).append(
+                f"{token}\t{' '.join(map(str, nums))}\n"
+            )
+        for name, lines in shards.items():
+            with open(self.folder / f"{name}{PART_SUFFIX}", "a", encoding="utf-8") as f:
+                f.writelines(lines)
+        self.postings = {}
+        self.held = 0
+
+    def finish(self):
+        """Write what is left of the index, and turn the part files into shards."""
+
+        if self.messages:
+            self.write_meta()
+        self.spill()
+        for part in self.folder.glob(f"*{PART_SUFFIX}"):
+            # messages are numbered in order, so later spills extend the lists
+            postings = {}
+            with open(part, encoding="utf-8") as f:
+                for line in f:
+                    token, nums = line.rstrip("\n").split("\t")
+                    postings.setdefault(token, []).extend(map(int, nums.split()))
+            for token, nums in postings.items():
+                postings[token] = [b - a for a, b in zip([0] + nums, nums)]
+            name = part.name[: -len(PART_SUFFIX)]
+            with open(self.folder / f"{name}.js", "w", encoding="utf-8") as f:
+                f.write(script("sigSearchShard", name, postings))
+            part.unlink()
+        with open(self.folder / "info.js", "w", encoding="utf-8") as f:
+            f.write(
+                script(
+                    "sigSearchInfo",
+                    {"messages": self.count, "chunk_size": CHUNK_SIZE},
+                )
+            )
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import json
+import mimetypes
 import sys
 import os
 import shutil
@@ -9,17 +10,66 @@ from datetime import datetime
 from babel.dates import format_datetime
 import re
 import locale
+import heapq
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 
 import click
-import markdown
 import uuid
-from bs4 import BeautifulSoup
-from get_data import fetch_data, filter_data, print_db_schema
+from get_data import (
+    fetch_data,
+    filter_data,
+    keep_message,
+    print_db_schema,
+    stream_data,
+    stream_messages,
+)
 from interact_with_llm import filter_by_LLM
+from attachments import COPY_MODES, MediaStore, copy_file, copy_files
+from html_render import attachment_kind, write_pages
+from metrics import Metrics
+from archive import add_conversation, add_messages, open_archive
+from dataset import write_dataset
+from thumbnails import THUMB_DIR, build_thumbnails, pillow_available
 
 
 log = False
 
+# set by main with --metrics
+metrics = None
+
+# set by main with --media-store
+media_store = None
+
+# set in HTML worker processes by init_html_worker
+worker_contacts = None
+worker_senders = None
+
+MSG_PATTERN = re.compile(r"^(\[\d{4}-\d{2}-\d{2},{0,1} \d{2}:\d{2}\])(.*?:)(.*\n)")
+ID_PATTERN = re.compile(r" <!-- id:([^\s>]+) -->\s*$")
+MEDIA_LINK_PATTERN = re.compile(r"(!?)\[([^\]]*)\]\((\./media/[^)\s]*)\) *")
+
+# high-water marks of --incremental exports, kept in the output directory
+STATE_FILE = ".export_state.json"
+
+# with --shard, the markdown of a chat is split in md/<year or year-month>.md
+# files, listed in its manifest
+SHARD_MODES = ["year", "month"]
+MANIFEST_FILE = "manifest.json"
+
+# attachment types of Signal missing from the mimetypes tables of older Pythons
+for content_type, extension in (
+    ("audio/aac", ".aac"),
+    ("image/heic", ".heic"),
+    ("image/heif", ".heif"),
+    ("image/webp", ".webp"),
+):
+    mimetypes.add_type(content_type, extension)
+
+# with --media-store, the single copy of each attachment, linked from the chats
+STORE_DIR = ".media"
+
 # Set the locale to French
 try:
     locale.setlocale(locale.LC_TIME, "fr_FR")
@@ -43,12 +93,30 @@ def source_location():
     return source_path
 
 
-def copy_attachments(src, dest, conversations, contacts):
-    """Copy attachments and reorganise in destination directory."""
+def stage(name):
+    """Time a stage of the export when --metrics is given."""
+
+    return metrics.stage(name) if metrics else nullcontext()
+
+
+def count(key, n, stage=None):
+    if metrics:
+        metrics.count(key, n, stage)
+
+
+def copy_attachments(src, dest, conversations, contacts, mode="copy", workers=8):
+    """Copy attachments and reorganise in destination directory.
+
+    Returns the list of attachments that could not be copied.
+    """
 
     src_att = Path(src) / "attachments.noindex"
     dest = Path(dest)
 
+    jobs = []
+    failures = []
+    # source of each destination, so that no two jobs write the same file
+    sources = {}
     for key, messages in conversations.items():
         name = contacts[key]["name"]
         if log:
@@ -59,45 +127,161 @@ def copy_attachments(src, dest, conversations, contacts):
         contact_path = dest / name / "media"
         contact_path.mkdir(exist_ok=True, parents=True)
         for msg in messages:
-            try:
-                attachments = msg["attachments"]
-                if attachments:
-                    date = datetime.fromtimestamp(msg["timestamp"] / 1000.0).strftime(
-                        "%Y-%m-%d"
-                    )
-                    for i, att in enumerate(attachments):
-                        try:
-                            att[
-                                "fileName"
-                            ] = f"{date}_{i:02}_{att['fileName']}".replace(
-                                " ", "_"
-                            ).replace(
-                                "/", "-"
-                            )
-                            # account for erroneous backslash in path
-                            att_path = str(att["path"]).replace("\\", "/")
-                            shutil.copy2(
-                                src_att / att_path, contact_path / att["fileName"]
-                            )
-                        except KeyError:
-                            if log:
-                                print(
-                                    f"\t\tBroken attachment:\t{name}\t{att['fileName']}"
-                                )
-                        except FileNotFoundError:
-                            if log:
-                                print(
-                                    f"\t\tAttachment not found:\t{name} {att['fileName']}"
-                                )
-            except KeyError:
+            if not msg.attachments:
+                continue
+            if msg.timestamp is None:
                 if log:
-                    print(f"\t\tNo attachments for a message: {name}")
+                    print(f"\t\tNo timestamp for a message with attachments: {name}")
+                continue
+            date = datetime.fromtimestamp(msg.timestamp / 1000.0).strftime("%Y-%m-%d")
+            for i, att in enumerate(msg.attachments):
+                att.file_name = f"{date}_{i:02}_{att.file_name}".replace(
+                    " ", "_"
+                ).replace("/", "-")
+                if att.path is None:
+                    info = {"conversation": name, "file": att.file_name}
+                    failures.append({**info, "source": None, "error": "Broken attachment"})
+                    continue
+                # account for erroneous backslash in path
+                source = src_att / str(att.path).replace("\\", "/")
+                dst = contact_path / att.file_name
+                n = 0
+                # another file of the same name, sent the same day
+                while sources.get(dst, source) != source:
+                    n += 1
+                    file_name = Path(att.file_name)
+                    dst = contact_path / f"{file_name.stem}_{n}{file_name.suffix}"
+                att.file_name = dst.name
+                if dst in sources:
+                    # the same file, sent twice the same day
+                    continue
+                sources[dst] = source
+                info = {"conversation": name, "file": att.file_name}
+                if att.plaintext_hash:
+                    info["hash"] = att.plaintext_hash
+                jobs.append((source, dst, info))
+
+    stored = media_store.bytes if media_store else 0
+    failures += copy_files(jobs, mode, workers, media_store)
+    if metrics and media_store is not None:
+        metrics.count("bytes", media_store.bytes - stored)
+    elif metrics:
+        failed = {failure["source"] for failure in failures}
+        metrics.count(
+            "bytes",
+            sum(os.path.getsize(dst) for src, dst, _ in jobs if str(src) not in failed),
+        )
+    if log:
+        for failure in failures:
+            print(
+                f"\t\t{failure['error']}:\t{failure['conversation']}\t{failure['file']}"
+            )
+    return failures
+
+
+def build_sender_index(contacts):
+    """Map phone numbers and service ids to contact names, first match wins."""
+
+    senders = {}
+    for contact in contacts.values():
+        for key in (contact["number"], contact.get("service_id")):
+            if key is not None:
+                senders.setdefault(key, contact["name"])
+    return senders
+
+
+def message_sender(msg, contacts, senders, is_group):
+    """Return the display name of the sender of a message, or None if unknown."""
+
+    if msg.type == "outgoing":
+        return "Me"
+    if not is_group:
+        contact = contacts.get(msg.conversation_id)
+        return contact["name"] if contact is not None else None
+    for key in (msg.source, msg.source_service_id, msg.source_uuid):
+        name = senders.get(key)
+        if name is not None:
+            return name
+    return None
+
+
+def message_date(msg):
+    """Return the date a message was sent, or None if it has no timestamp."""
 
+    timestamp = msg.time
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp / 1000.0)
 
-def make_simple(dest, conversations, contacts):
-    """Output each conversation into a simple text file."""
+
+def is_exported(msg):
+    """Whether a message is exported at all, see Message."""
+
+    return msg.attachments is not None
+
+
+def reaction_senders(msg, contacts):
+    """Return an (emoji, name) pair for each reaction to a message by a contact."""
+
+    pairs = []
+    for reaction in msg.reactions:
+        contact = contacts.get(reaction.from_id)
+        if contact is None:
+            continue
+        pairs.append((reaction.emoji, contact["name"]))
+    return pairs
+
+
+def message_reactions(msg, contacts):
+    """Return an "emoji name" line for each reaction to a message."""
+
+    return [f"{emoji} {name}" for emoji, name in reaction_senders(msg, contacts)]
+
+
+def media_src(file_name):
+    """Relative link to an attachment copied to the media folder of a chat."""
+
+    return "./" + str(Path("media") / file_name).replace(" ", "%20")
+
+
+def thumb_srcs(sub, thumbs):
+    """Map the media_src of images of chat directory sub to their thumbnail's.
+
+    thumbs are the thumbnails of the chat by file name (see build_thumbnails).
+    """
+
+    if not thumbs:
+        return None
+    return {
+        media_src(name): Path(os.path.relpath(path, sub)).as_posix()
+        for name, path in thumbs.items()
+    }
+
+
+def make_thumbnails(dest, names=None, jobs=1, pool=None):
+    """Thumbnail the images of every conversation directory, or those in names.
+
+    pool is passed on to build_thumbnails. Returns the thumbnails by file
+    name, by conversation directory name.
+    """
+
+    folders = [sub for sub in chat_dirs(dest) if names is None or sub.name in names]
+    thumbs = build_thumbnails(folders, dest / THUMB_DIR, jobs, pool=pool)
+    count("thumbnails", sum(len(chat) for chat in thumbs.values()))
+    return thumbs
+
+
+def make_simple(dest, conversations, contacts, senders=None, shard=None):
+    """Output each conversation into a simple text file.
+
+    With shard ("year" or "month"), each conversation gets a file per
+    period instead, see chat_md_path, and only the files written to are
+    read again to update its manifest.
+    """
 
     dest = Path(dest)
+    if senders is None:
+        senders = build_sender_index(contacts)
     for key, messages in conversations.items():
         name = contacts[key]["name"]
         if log:
@@ -106,23 +290,17 @@ def make_simple(dest, conversations, contacts):
         # some contact names are None
         if name is None:
             name = "None"
-        mdfile = open(dest / name / "index.md", "a")
+        sub = dest / name
+        md_key = None
+        mdfile = open(chat_md_path(sub), "a") if shard is None else None
+        touched = set()
 
         for msg in messages:
-            timestamp = (
-                msg["timestamp"]
-                if "timestamp" in msg
-                else msg["sent_at"]
-                if "sent_at" in msg
-                else None
-            )
-
-            if timestamp is None:
+            date = message_date(msg)
+            if date is None:
                 if log:
                     print("\t\tNo timestamp or sent_at; date set to 1970")
                 date = datetime(year=1970, month=1, day=1)
-            else:
-                date = datetime.fromtimestamp(timestamp / 1000.0)
 
             date_str = date.strftime("%Y-%m-%d %H:%M")
             
@@ -132,79 +310,168 @@ def make_simple(dest, conversations, contacts):
             if log:
                 print(f"\t\tDoing {name}, msg: {date_str}")
 
-            try:
-                body = msg["body"]
-            except KeyError:
+            body = msg.body
+            if body is None:
                 if log:
                     print(f"\t\tNo body:\t\t{date_str}")
                 body = ""
-            if body is None:
-                body = ""
             body = body.replace("`", "")  # stop md code sections forming
             body += "  "  # so that markdown newlines
             
-            try:
-                test = msg["reactions"]
-                for reaction in test:
-                    body += "\n" 
-                    body += "\t" + reaction['emoji'] + " " + contacts[reaction['fromId']]['name']
-                    body += "  "  # so that markdown newlines
-                    body += "\n" 
-
-
-                    print(reaction)
-                    print(reaction['emoji'], "from", reaction['fromId'])
-                    print("tutu")
-                    print("is in:", contacts[msg["conversationId"]]["name"])
-                    print("body", test)
-                    #print()
-            except KeyError:
+            if not msg.reactions and log:
+                print(f"\t\tNo reaction:\t\t{date_str}")
+            for reaction in message_reactions(msg, contacts):
+                body += "\n"
+                body += "\t" + reaction
+                body += "  "  # so that markdown newlines
+                body += "\n"
+
+            sender = message_sender(msg, contacts, senders, is_group)
+            if sender is None:
                 if log:
-                    print(f"\t\tNo reaction:\t\t{date_str}")
-
-            sender = "No-Sender"
-            if "type" in msg.keys() and msg["type"] == "outgoing":
-                sender = "Me"
-            else:
-                try:
-                    if is_group:
-                        for c in contacts.values():
-                            num = c["number"]
-                            if num is not None and num == msg["source"]:
-                                sender = c["name"]
-                                # print("sender is", sender)
-                    else:
-                        sender = contacts[msg["conversationId"]]["name"]
-                        # print("sender is", sender)
-                except KeyError:
-                    if log:
-                        print(f"\t\tNo sender:\t\t{date_str}")
-
-            try:
-                attachments = msg["attachments"]
-                for att in attachments:
-                    file_name = att["fileName"]
-                    # some file names are None
-                    if file_name is None:
-                        print('File name is none. You have an issue with data creation')
-                        exit()
-                    path = Path("media") / file_name
-                    path = Path(str(path).replace(" ", "%20"))
-                    if path.suffix and path.suffix.split(".")[1] in [
-                        "png",
-                        "jpg",
-                        "jpeg",
-                        "gif",
-                        "tif",
-                        "tiff",
-                    ]:
-                        body += "!"
-                    body += f"[{file_name}](./{path})  "
-                print(f"[{date_str}] {sender}: {body}", file=mdfile)
-            except KeyError:
+                    print(f"\t\tNo sender:\t\t{date_str}")
+                sender = "No-Sender"
+
+            if not is_exported(msg):
                 if log:
                     print(f"\t\tNo attachments for a message: {name}, {date_str}")
+                continue
+            for att in msg.attachments:
+                file_name = att.file_name
+                # some file names are None
+                if file_name is None:
+                    print('File name is none. You have an issue with data creation')
+                    exit()
+                path = Path("media") / file_name
+                path = Path(str(path).replace(" ", "%20"))
+                # typed like the attachments of HTML pages rendered from records
+                if attachment_kind(att.content_type) == "image":
+                    body += "!"
+                body += f"[{file_name}](./{path})  "
+            if shard is not None and (mdfile is None or shard_key(date_str, shard) != md_key):
+                if mdfile is not None:
+                    mdfile.close()
+                md_key = shard_key(date_str, shard)
+                touched.add(md_key)
+                mdfile = open(chat_md_path(sub, md_key), "a")
+            # keep the id on the last line of text of the message
+            entry = f"[{date_str}] {sender}: {body}"
+            text = entry.rstrip("\n")
+            print(text + id_marker(msg) + entry[len(text):], file=mdfile)
+        if mdfile is not None:
+            mdfile.close()
+        if shard is not None:
+            update_manifest(sub, shard, touched)
+
+
+def shard_key(date_str, shard):
+    """The shard of an index.md date ("2019-03-05 12:00"): "2019" or "2019-03"."""
+
+    return date_str[:4] if shard == "year" else date_str[:7]
+
+
+def chat_md_path(sub, key=None):
+    """The markdown file of a chat, or of one of its shards."""
+
+    if key is None:
+        return sub / "index.md"
+    (sub / "md").mkdir(exist_ok=True)
+    return sub / "md" / f"{key}.md"
+
+
+def load_manifest(sub):
+    path = sub / MANIFEST_FILE
+    if not path.exists():
+        return None
+    with path.open() as f:
+        return json.load(f)
+
+
+def update_manifest(sub, shard, keys=None):
+    """List the shards of a chat in its manifest, with their message count
+    and date range.
+
+    Only the shards in keys are read again (all of them if keys is None).
+    """
 
+    manifest = load_manifest(sub) if keys is not None else None
+    shards = {entry["key"]: entry for entry in manifest["shards"]} if manifest else {}
+    if keys is None:
+        keys = [path.stem for path in (sub / "md").glob("*.md")]
+    for key in keys:
+        path = sub / "md" / f"{key}.md"
+        if not path.exists():
+            shards.pop(key, None)
+            continue
+        count = 0
+        first = last = None
+        with path.open() as f:
+            for msg in iter_msgs(f):
+                last = msg[0][1:-1].replace(",", "")
+                first = first or last
+                count += 1
+        shards[key] = {
+            "key": key,
+            "file": f"md/{key}.md",
+            "messages": count,
+            "first": first,
+            "last": last,
+        }
+    manifest = {"shard": shard, "shards": [shards[key] for key in sorted(shards)]}
+    tmp = sub / (MANIFEST_FILE + ".tmp")
+    with tmp.open("w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, sub / MANIFEST_FILE)
+
+
+def chat_layout(sub):
+    """The --shard mode a chat directory was written with (None if unsharded)."""
+
+    manifest = load_manifest(sub)
+    return manifest["shard"] if manifest else None
+
+
+def chat_md_files(sub):
+    """The markdown files of a chat, in date order, whatever its layout."""
+
+    manifest = load_manifest(sub)
+    if manifest is None:
+        path = chat_md_path(sub)
+        return [path] if path.exists() else []
+    return [sub / entry["file"] for entry in manifest["shards"]]
+
+
+def iter_chat_msgs(sub):
+    """Yield the [date, sender, body] messages of a chat, streamed from its files."""
+
+    for path in chat_md_files(sub):
+        with path.open() as f:
+            yield from iter_msgs(f)
+
+
+def write_shards(sub, msgs, shard):
+    """Replace the shards of a chat with the date-ordered msgs."""
+
+    tmp = sub / "md.tmp"
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir()
+    out = None
+    key = None
+    for msg in msgs:
+        msg_key = shard_key(msg[0][1:-1].replace(",", ""), shard)
+        if out is None or msg_key != key:
+            if out is not None:
+                out.close()
+            key = msg_key
+            out = open(tmp / f"{key}.md", "a")
+        out.write(msg[0] + msg[1] + msg[2])
+    if out is not None:
+        out.close()
+    if (sub / "md").exists():
+        shutil.rmtree(sub / "md")
+    os.replace(tmp, sub / "md")
+    update_manifest(sub, shard)
 
 
 def fix_names(contacts):
@@ -219,244 +486,571 @@ def fix_names(contacts):
     return contacts
 
 
-def create_html(dest, msgs_per_page=100):
+def copy_static(dest):
+    """Copy the stylesheet and the search script shared by all chats."""
+
     root = Path(__file__).resolve().parents[0]
-    css_source = root / "style.css"
-    css_dest = dest / "style.css"
-    if os.path.isfile(css_source):
-        shutil.copy2(css_source, css_dest)
-    else:
-        print(
-            f"Stylesheet ({css_source}) not found."
-            f"You might want to install one manually at {css_dest}."
-        )
+    for file in ("style.css", "search.js"):
+        source = root / file
+        if os.path.isfile(source):
+            shutil.copy2(source, dest / file)
+        else:
+            print(
+                f"{file} ({source}) not found."
+                f"You might want to install one manually at {dest / file}."
+            )
 
-    md = markdown.Markdown()
 
-    for sub in dest.iterdir():
-        if sub.is_dir():
-            name = sub.stem
-            if log:
-                print(f"\tDoing html for {name}")
-            path = sub / "index.md"
-            # touch first
-            open(path, "a")
-            with path.open() as f:
-                lines = f.readlines()
-            lines = lines_to_msgs(lines)
-            last_page = int(len(lines) / msgs_per_page)
-            htfile = open(sub / "index.html", "w")
-            print(
-                "<!doctype html>"
-                "<html lang='en'><head>"
-                "<meta charset='utf-8'>"
-                f"<title>{name}</title>"
-                "<link rel=stylesheet href='../style.css'>"
-                "</head>"
-                "<body>"
-                "<style>"
-                "img.emoji {"
-                "height: 1em;"
-                "width: 1em;"
-                "margin: 0 .05em 0 .1em;"
-                "vertical-align: -0.1em;"
-                "}"
-                "</style>"
-                "<script src='https://cdn.jsdelivr.net/npm/twemoji@14.0.2/dist/twemoji.min.js?11.2'></script>"
-                "<script>window.onload = function () { twemoji.parse(document.body);}</script>",
-                file=htfile,
+def create_html(
+    dest,
+    msgs_per_page=100,
+    names=None,
+    conversations=None,
+    contacts=None,
+    senders=None,
+    jobs=1,
+    thumbs=None,
+):
+    """Render every conversation directory, or only those in names if given.
+
+    Chats are rendered from their markdown, or straight from the fetched
+    messages when conversations, contacts and senders are given and the chat
+    directory holds exactly one conversation. With jobs > 1 chats are
+    rendered in that many processes; each chat is still written by a single
+    process, so the output is the same as a serial run. Image grids show
+    the thumbs made by make_thumbnails, if given.
+    Returns the number of messages rendered.
+    """
+
+    copy_static(dest)
+    sources = {}
+    if conversations is not None:
+        for key, messages in conversations.items():
+            name = contacts[key]["name"] or "None"
+            # chats sharing a directory are merged in index.md
+            sources[name] = None if name in sources else key
+
+    tasks = []
+    for sub in chat_dirs(dest):
+        if names is None or sub.name in names:
+            key = sources.get(sub.name)
+            messages = conversations[key] if key is not None else None
+            chat_thumbs = thumb_srcs(sub, (thumbs or {}).get(sub.name))
+            tasks.append((sub, messages, key, chat_thumbs))
+
+    if jobs <= 1:
+        return sum(
+            render_chat(
+                sub, msgs_per_page, messages, key, contacts, senders, chat_thumbs
             )
+            for sub, messages, key, chat_thumbs in tasks
+        )
 
-            page_num = 0
-            for i, msg in enumerate(lines):
-                if i % msgs_per_page == 0:
-                    nav = ""
-                    if i > 0:
-                        nav += "&nbsp;"
-                    nav += f"&nbsp;"
-                    nav += "&nbsp;"
-                    nav += "&nbsp;"
-                    if page_num != 0:
-                        nav += f"&nbsp;"
-                    else:
-                        nav += "&nbsp;"
-                    nav += "</div><div class=next>"
-                    if page_num != last_page:
-                        nav += f"&nbsp;"
-                    else:
-                        nav += "&nbsp;"
-                    nav += "</div></nav>"
-                    print(nav, file=htfile)
-                    page_num += 1
-
-                date, sender, body = msg
-                sender = sender[1:-1]
-                date, time = date[1:-1].replace(",", "").split(" ")
-
-
-                
-                body = md.convert(body)
-
-                # links
-                p = r"(https{0,1}://\S*)"
-                template = r"<a href='\1' target='_blank'>\1</a> "
-                body = re.sub(p, template, body)
-
-                # images
-                soup = BeautifulSoup(body, "html.parser")
-
-                # images
-                imgs = soup.find_all("img")
-                # Create a container for images if there are images
-                if imgs:
-                    img_grid_container = soup.new_tag('div', **{'class': 'img-grid'})
-
-                for im in imgs:
-                    if im.get("src"):
-                        temp = BeautifulSoup(figure_template, "html.parser")
-                        src = im["src"]
-                        temp.figure.label.img["src"] = src
-                        alt = im["alt"]
-                        temp.figure.label.img["alt"] = alt
-                        temp.figure.input["id"] = alt
-                        temp.figure.label["for"] = alt
-        
-                        #  Add the figure to the img-grid container
-                        img_grid_container.append(temp.figure)
-
-                # Replace old images with new img-grid container
-                for im in imgs:
-                    im.replace_with(img_grid_container)
-                    # voice notes
-                    voices = soup.select(r"a[href*=\.m4a]")
-
-                # voice notes
-                voices = soup.select(r"a[href*=\.m4a]")
-                for v in voices:
-                    href = v["href"]
-                    temp = BeautifulSoup(audio_template, "html.parser")
-                    temp.audio.source["src"] = href
-                    v.replace_with(temp)
-
-                # videos
-                videos = soup.select(r"a[href*=\.mp4]")
-                for v in videos:
-                    href = v["href"]
-                    temp = BeautifulSoup(video_template, "html.parser")
-                    temp.video.source["src"] = href
-                    v.replace_with(temp)
-
-                cl = "msg me" if sender == "Me" else "msg"
-                print(
-                    f"<div class='{cl}'><span class=date>{date}</span>"
-                    f"<span class=time>{time}</span>",
-                    f"<span class=sender>{sender}</span>"
-                    f"<span class=body>{soup.prettify()}</span></div>",
-                    file=htfile,
-                )
-            print("</div>", file=htfile)
-            print(
-                "<script>if (!document.location.hash){"
-                "document.location.hash = 'pg0';}</script>",
-                file=htfile,
+    # largest chats first, so that the run doesn't end waiting on a big one
+    tasks.sort(key=lambda task: chat_size(task[0]), reverse=True)
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=init_html_worker,
+        initargs=(contacts, senders, log),
+    ) as pool:
+        futures = [
+            pool.submit(
+                render_chat, sub, msgs_per_page, messages, key, thumbs=chat_thumbs
             )
-            print("</body></html>", file=htfile)
-
-
-video_template = """
-<video controls>
-    <source src="src" type="video/mp4">
-    </source>
-</video>
-"""
-
-audio_template = """
-<audio controls>
-<source src="src" type="audio/mp4">
-</audio>
-"""
-
-figure_template = """
-<figure>
-    <label for="src">
-        <img load="lazy" src="src" alt="img">
-    </label>
-    <input class="modal-state" id="src" type="checkbox">
-    <div class="modal">
-        <label for="src">
-            <div class="modal-content">
-                <img class="modal-photo" loading="lazy" src="src" alt="img">
-            </div>
-        </label>
-    </div>
-</figure>
-"""
+            for sub, messages, key, chat_thumbs in tasks
+        ]
+        return sum(future.result() for future in futures)
+
+
+def chat_size(sub):
+    return sum(path.stat().st_size for path in chat_md_files(sub))
+
+
+def init_html_worker(contacts, senders, verbose):
+    """Hand the contacts to an HTML worker process once, rather than with each chat."""
+
+    global worker_contacts, worker_senders, log
+    worker_contacts = contacts
+    worker_senders = senders
+    log = verbose
+
+
+def render_chat(
+    sub,
+    msgs_per_page,
+    messages=None,
+    key=None,
+    contacts=None,
+    senders=None,
+    thumbs=None,
+):
+    """Render a chat directory, from its messages if given.
+
+    In HTML worker processes contacts and senders default to the ones given
+    to init_html_worker.
+    """
+
+    records = None
+    if messages is not None:
+        if contacts is None:
+            contacts, senders = worker_contacts, worker_senders
+        records = chat_records(messages, contacts, senders, key)
+    return create_chat_html(sub, msgs_per_page, records, thumbs)
+
+
+def chat_records(messages, contacts, senders, key):
+    """Yield the HTML records (see html_render) of a conversation's messages."""
+
+    is_group = contacts[key]["is_group"]
+    for msg in messages:
+        if not is_exported(msg):
+            continue
+        date = message_date(msg) or datetime(year=1970, month=1, day=1)
+        sender = message_sender(msg, contacts, senders, is_group) or "No-Sender"
+        text = msg.body or ""
+        for reaction in message_reactions(msg, contacts):
+            text += "\n\t" + reaction
+        attachments = [
+            (
+                attachment_kind(att.content_type),
+                media_src(att.file_name),
+                att.file_name,
+                att.content_type,
+            )
+            for att in msg.attachments
+        ]
+        yield date.strftime("%Y-%m-%d"), date.strftime("%H:%M"), sender, text, attachments
+
+
+def archive_records(messages, contacts, senders, key):
+    """Yield the archive records (see archive) of a conversation's messages."""
+
+    name = contacts[key]["name"] or "None"
+    is_group = contacts[key]["is_group"]
+    for msg in messages:
+        if not is_exported(msg):
+            continue
+        sent_at = msg.sent_at or msg.timestamp
+        attachments = [
+            (
+                att.file_name,
+                att.content_type,
+                f"{name}/media/{att.file_name}",
+                att.size,
+            )
+            for att in msg.attachments
+        ]
+        yield (
+            msg.id,
+            sent_at,
+            message_sender(msg, contacts, senders, is_group),
+            msg.type,
+            msg.body or "",
+            attachments,
+            reaction_senders(msg, contacts),
+        )
+
+
+def archive_chats(db, conversations, contacts, senders):
+    """Add conversations to an archive opened with archive.open_archive.
+
+    Returns the number of messages archived.
+    """
+
+    archived = 0
+    for key, messages in conversations.items():
+        contact = contacts[key]
+        add_conversation(
+            db, key, contact["name"], contact["number"], contact["is_group"]
+        )
+        archived += add_messages(
+            db, key, archive_records(messages, contacts, senders, key)
+        )
+    return archived
+
+
+def dataset_records(messages, contacts, senders, year=None, attachments_only=False):
+    """Yield the dataset records (see dataset) of (conversation id, Message) pairs."""
+
+    for key, msg in messages:
+        if not is_exported(msg) or not keep_message(msg, year, attachments_only):
+            continue
+        yield {
+            "id": msg.id,
+            "conversation_id": key,
+            "sender": message_sender(msg, contacts, senders, contacts[key]["is_group"]),
+            "timestamp": msg.time,
+            "type": msg.type,
+            "body": msg.body or "",
+            "attachments": [att.content_type for att in msg.attachments],
+            "reactions": [
+                {"emoji": emoji, "sender": name}
+                for emoji, name in reaction_senders(msg, contacts)
+            ],
+        }
+
+
+def export_dataset(
+    dest, messages, contacts, senders, year=None, attachments_only=False
+):
+    """Write the streamed (conversation id, Message) pairs as a dataset in dest.
+
+    Returns the number of messages written.
+    """
+
+    exported = set()
+
+    def records():
+        for record in dataset_records(
+            messages, contacts, senders, year, attachments_only
+        ):
+            exported.add(record["conversation_id"])
+            yield record
+
+    # read once every message is written, so only the exported ones are listed
+    conversations = (
+        {
+            "id": key,
+            "name": contacts[key]["name"],
+            "number": contacts[key]["number"],
+            "is_group": contacts[key]["is_group"],
+        }
+        for key in contacts
+        if key in exported
+    )
+    return write_dataset(dest, records(), conversations)
+
+
+def md_record(msg):
+    """Turn a [date, sender, body] message of index.md into an HTML record."""
+
+    date, sender, body = msg
+    sender = sender[1:-1]
+    date, time = date[1:-1].replace(",", "").split(" ")
+    # drop the space following "sender:"
+    body = ID_PATTERN.sub("", body[1:] if body.startswith(" ") else body)
+    attachments = []
+    for image, name, src in MEDIA_LINK_PATTERN.findall(body):
+        # the markdown has no content types, but file names end with the
+        # extension of theirs (see get_data.add_file_name)
+        content_type, _ = mimetypes.guess_type(name)
+        kind = "image" if image else attachment_kind(content_type)
+        attachments.append((kind, src, name, content_type))
+    text = MEDIA_LINK_PATTERN.sub("", body)
+    text = "\n".join(line.rstrip() for line in text.rstrip().split("\n"))
+    return date, time, sender, text, attachments
+
+
+def create_chat_html(sub, msgs_per_page=100, records=None, thumbs=None):
+    """Render one conversation directory to HTML pages and an index.html.
+
+    Messages are streamed from its markdown unless records are given. thumbs
+    maps the src of images to the src of their thumbnail (see thumb_srcs).
+    Returns the number of messages rendered.
+    """
+
+    name = sub.stem
+    if log:
+        print(f"\tDoing html for {name}")
+    if records is not None:
+        return write_pages(sub, name, records, msgs_per_page, thumbs)
+    if chat_layout(sub) is None:
+        # touch first
+        open(chat_md_path(sub), "a").close()
+    return write_pages(
+        sub,
+        name,
+        (md_record(msg) for msg in iter_chat_msgs(sub)),
+        msgs_per_page,
+        thumbs,
+    )
 
 
 def lines_to_msgs(lines):
-    p = re.compile(r"^(\[\d{4}-\d{2}-\d{2},{0,1} \d{2}:\d{2}\])(.*?:)(.*\n)")
-    msgs = []
+    return list(iter_msgs(lines))
+
+
+def iter_msgs(lines):
+    """Yield the [date, sender, body] messages of index.md lines one at a time."""
+
+    msg = None
     for li in lines:
-        m = p.match(li)
+        m = MSG_PATTERN.match(li)
         if m:
-            msgs.append(list(m.groups()))
-        else:
-            msgs[-1][-1] += li
-    return msgs
+            if msg is not None:
+                yield msg
+            msg = list(m.groups())
+        elif msg is not None:
+            msg[-1] += li
+    if msg is not None:
+        yield msg
+
+
+def id_marker(msg):
+    """Invisible tag carrying the Signal message id at the end of an index.md message."""
+
+    if msg.id is None:
+        return ""
+    return f" <!-- id:{msg.id} -->"
+
+
+def split_id(msg):
+    """Return the Signal id of an index.md message (None for older exports)
+    and its text without the id marker."""
+
+    text = msg[1] + msg[2]
+    m = ID_PATTERN.search(text)
+    if m is None:
+        return None, text.rstrip()
+    return m.group(1), text[: m.start()].rstrip()
+
+
+def report_copy_failures(failures):
+    if failures:
+        print(f"\n{len(failures)} attachments could not be copied")
+        if not log:
+            print("Use --verbose to list them.")
+
+
+def report_media_store():
+    if media_store is not None:
+        print(
+            f"\n{media_store.linked} attachments linked to "
+            f"{media_store.stored} new files in {STORE_DIR}"
+        )
 
 
 def merge_attachments(media_new, media_old):
+    media_new.mkdir(exist_ok=True)
     for f in media_old.iterdir():
-        if f.is_file():
-            shutil.copy2(f, media_new)
+        if f.is_file() and media_store is not None:
+            # files already in the store, old or new, are not copied again
+            media_store.copy(f, media_new / f.name)
+        elif f.is_file():
+            # replaces rather than overwrites files hardlinked to Signal's
+            copy_file(f, media_new / f.name)
 
 
-def merge_chat(path_new, path_old):
-    with path_old.open() as f:
-        old = f.readlines()
-    with path_new.open() as f:
-        new = f.readlines()
+def merge_msgs(old_msgs, new_msgs):
+    """Merge two timestamp-ordered streams of index.md messages.
 
-    try:
-        a, b, c, d = old[0][:30], old[-1][:30], new[0][:30], new[-1][:30]
-        if log:
-            print(f"\t\tFirst line old:\t{a}")
-            print(f"\t\tLast line old:\t{b}")
-            print(f"\t\tFirst line new:\t{c}")
-            print(f"\t\tLast line new:\t{d}")
-    except IndexError:
-        if log:
-            print("\t\tNo new messages for this conversation")
+    Both are streamed, so memory use does not grow with their length.
+    Messages are deduplicated on their Signal id, and on their text for
+    exports made before ids were written, among messages of the same minute.
+    """
+
+    kept = skipped = 0
+    # heapq.merge is stable, so old messages come first within a minute
+    merged = heapq.merge(old_msgs, new_msgs, key=lambda m: m[0].replace(",", ""))
+    minute = None
+    for msg in merged:
+        date = msg[0].replace(",", "")
+        if minute is None or date > minute:
+            minute = date
+            seen_ids = set()
+            seen_texts = set()
+            # texts written without/with an id, not matched by the other kind yet
+            untagged = Counter()
+            tagged = Counter()
+
+        id, text = split_id(msg)
+        if id is not None:
+            duplicate = id in seen_ids
+            seen_ids.add(id)
+            if not duplicate and untagged[text]:
+                untagged[text] -= 1
+                duplicate = True
+            elif not duplicate:
+                tagged[text] += 1
+        else:
+            duplicate = text in seen_texts
+            seen_texts.add(text)
+            if not duplicate and tagged[text]:
+                tagged[text] -= 1
+                duplicate = True
+            elif not duplicate:
+                untagged[text] += 1
+
+        if duplicate:
+            skipped += 1
+        else:
+            kept += 1
+            yield msg
+    if log:
+        print(f"\t\tMerged {kept} messages, {skipped} duplicates dropped")
+
+
+def merge_chat(sub, dir_old, shard=None):
+    """Merge the markdown of a previous export of a chat into the chat
+    directory sub. Either may be sharded or not."""
+
+    merged = merge_msgs(iter_chat_msgs(dir_old), iter_chat_msgs(sub))
+    if shard is not None:
+        write_shards(sub, merged, shard)
         return
+    path_new = chat_md_path(sub)
+    tmp = path_new.with_suffix(".md.tmp")
+    with tmp.open("w") as out:
+        for msg in merged:
+            out.write(msg[0] + msg[1] + msg[2])
+    os.replace(tmp, path_new)
 
-    old = lines_to_msgs(old)
-    new = lines_to_msgs(new)
 
-    merged = old + new
-    merged = [m[0] + m[1] + m[2] for m in merged]
-    merged = list(dict.fromkeys(merged))
+def chat_dirs(dest):
+    """The conversation directories of an export."""
 
-    with path_new.open("w") as f:
-        f.writelines(merged)
+    return [
+        sub for sub in dest.iterdir() if sub.is_dir() and not sub.name.startswith(".")
+    ]
 
 
-def merge_with_old(dest, old):
-    for sub in dest.iterdir():
-        if sub.is_dir():
-            name = sub.stem
-            if log:
-                print(f"\tMerging {name}")
-            dir_old = old / name
-            if dir_old.is_dir():
-                merge_attachments(sub / "media", dir_old / "media")
-                path_new = sub / "index.md"
-                path_old = dir_old / "index.md"
-                try:
-                    merge_chat(path_new, path_old)
-                except FileNotFoundError:
-                    if log:
-                        print(f"\tNo old for {name}")
-                print()
+def merge_with_old(dest, old, shard=None):
+    for sub in chat_dirs(dest):
+        merge_chat_dir(sub, old, shard)
+
+
+def merge_chat_dir(sub, old, shard=None):
+    """Merge the previous export of one conversation directory into it."""
+
+    name = sub.stem
+    if log:
+        print(f"\tMerging {name}")
+    dir_old = old / name
+    if dir_old.is_dir():
+        merge_attachments(sub / "media", dir_old / "media")
+        if chat_md_files(dir_old):
+            merge_chat(sub, dir_old, shard)
+        elif log:
+            print(f"\tNo old for {name}")
+        print()
+
+
+def load_state(dest):
+    """Read the high-water marks of a previous incremental export, if any."""
+
+    path = Path(dest) / STATE_FILE
+    if not path.is_file():
+        return {}
+    with path.open() as f:
+        return json.load(f)["conversations"]
+
+
+def save_state(dest, state):
+    path = Path(dest) / STATE_FILE
+    tmp = path.with_suffix(".tmp")
+    with tmp.open("w") as f:
+        json.dump({"version": 1, "conversations": state}, f)
+    # replace atomically so an interrupted run never leaves a truncated state
+    os.replace(tmp, path)
+
+
+def update_state(state, conversations):
+    """Record the last sent_at exported per conversation, and the ids sent then."""
+
+    for key, messages in conversations.items():
+        mark = state.get(key, {"sent_at": None, "ids": []})
+        for msg in messages:
+            sent_at = msg.sent_at
+            if sent_at is None:
+                continue
+            if mark["sent_at"] is None or sent_at > mark["sent_at"]:
+                mark = {"sent_at": sent_at, "ids": []}
+            if sent_at == mark["sent_at"]:
+                mark["ids"].append(msg.id)
+        if mark["sent_at"] is not None:
+            state[key] = mark
+
+
+def export_streaming(
+    src,
+    dest,
+    conversations,
+    contacts,
+    senders,
+    year,
+    attachments_only,
+    old=None,
+    copy_mode="copy",
+    copy_workers=8,
+    state=None,
+    msgs_per_page=100,
+    archive=None,
+    shard=None,
+    thumbnail_jobs=0,
+):
+    """Run the copy, markdown, merge and HTML stages one conversation at a time.
+
+    If state is given, it is updated and saved after each conversation.
+    If archive is given (see archive.open_archive), the messages are added
+    to it as well. With thumbnail_jobs, images are thumbnailed in that many
+    processes before rendering, started once for all conversations.
+    Returns the list of attachments that could not be copied.
+    """
+
+    failures = []
+    rendered = set()
+    copy_static(dest)
+    if metrics:
+        # the database is read lazily, as conversations are asked for
+        conversations = metrics.timed("fetch", conversations)
+    thumbnailers = nullcontext()
+    if thumbnail_jobs > 1:
+        thumbnailers = ProcessPoolExecutor(max_workers=thumbnail_jobs)
+    with thumbnailers as pool:
+        for key, messages in conversations:
+            count("rows", len(messages), "fetch")
+            with stage("filter"):
+                convo, _ = filter_data(
+                    {key: messages}, contacts, year, attachments_only
+                )
+            if not convo:
+                continue
+            name = contacts[key]["name"]
+            if name is None:
+                name = "None"
+            print(f"\nExporting {name}")
+            with stage("copy attachments"):
+                failures += copy_attachments(
+                    src, dest, convo, contacts, copy_mode, copy_workers
+                )
+            with stage("markdown"):
+                make_simple(dest, convo, contacts, senders, shard)
+                count("messages", len(convo[key]))
+            if old:
+                with stage("merge"):
+                    merge_chat_dir(dest / name, Path(old), shard)
+            records = None
+            # render from index.md when it holds more than these messages
+            if not old and state is None and name not in rendered:
+                records = chat_records(convo[key], contacts, senders, key)
+            rendered.add(name)
+            thumbs = None
+            if thumbnail_jobs:
+                with stage("thumbnails"):
+                    thumbs = make_thumbnails(dest, {name}, pool=pool).get(name)
+            with stage("html"):
+                count(
+                    "messages",
+                    create_chat_html(
+                        dest / name,
+                        msgs_per_page,
+                        records,
+                        thumb_srcs(dest / name, thumbs),
+                    ),
+                )
+            if archive is not None:
+                with stage("archive"):
+                    count("messages", archive_chats(archive, convo, contacts, senders))
+            if state is not None:
+                update_state(state, convo)
+                save_state(dest, state)
+    return failures
+
+
+def write_metrics(path):
+    if metrics:
+        metrics.write(path)
+        print(f"\nMetrics written to {path}")
 
 
 @click.command()
@@ -497,6 +1091,19 @@ def merge_with_old(dest, old):
     default=False,
     help="Whether to manually decrypt the db",
 )
+@click.option(
+    "--snapshot-cache",
+    is_flag=True,
+    default=False,
+    help="Keep a decrypted copy of the db in ~/.cache/sigexport/snapshots "
+    "(readable only by you) and reuse it while the db is unchanged",
+)
+@click.option(
+    "--projection",
+    is_flag=True,
+    default=False,
+    help="Only decode the message fields used by the export (needs JSON support in SQLite)",
+)
 @click.option(
     "--conversation-id",
     "-i",
@@ -514,6 +1121,90 @@ def merge_with_old(dest, old):
     is_flag=True,
     help="Only include messages with attachments."
 )
+@click.option(
+    "--stream",
+    is_flag=True,
+    default=False,
+    help="Export one conversation at a time to bound memory use",
+)
+@click.option(
+    "--copy-mode",
+    type=click.Choice(COPY_MODES),
+    default="copy",
+    help="How to copy attachments: copy bytes, hardlink or reflink (clone). "
+    "Links fall back to copying across filesystems",
+)
+@click.option(
+    "--media-store",
+    "use_media_store",
+    is_flag=True,
+    default=False,
+    help=f"Copy each distinct attachment once, to {STORE_DIR} in DEST, "
+    "and link the chats' media files to it",
+)
+@click.option(
+    "--copy-workers",
+    type=int,
+    default=8,
+    help="Number of threads copying attachments",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    help="Number of processes rendering HTML files and thumbnails",
+)
+@click.option(
+    "--thumbnails",
+    "make_thumbs",
+    is_flag=True,
+    default=False,
+    help=f"Show thumbnails in the HTML image grids, cached in {THUMB_DIR} in DEST "
+    "(needs Pillow)",
+)
+@click.option(
+    "--page-size",
+    type=int,
+    default=100,
+    help="Number of messages per HTML page",
+)
+@click.option(
+    "--metrics",
+    "metrics_file",
+    type=click.Path(),
+    help="Write per-stage timings and counters as JSON to this file",
+)
+@click.option(
+    "--profile-dir",
+    type=click.Path(),
+    help="With --metrics, dump a cProfile of each stage in this directory",
+)
+@click.option(
+    "--shard",
+    type=click.Choice(SHARD_MODES),
+    help="Split the markdown of each chat in one file per year or month",
+)
+@click.option(
+    "--archive",
+    "archive_file",
+    type=click.Path(dir_okay=False),
+    help="Also write the messages to this SQLite archive, searchable with archive.py",
+)
+@click.option(
+    "--dataset",
+    is_flag=True,
+    default=False,
+    help="Write the messages to DEST as gzipped JSON lines, one message per line, "
+    "instead of markdown and HTML",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Only export messages newer than the previous --incremental run into DEST, "
+    "appending to existing chats",
+)
 
 def main(
     dest,
@@ -522,11 +1213,26 @@ def main(
     overwrite=False,
     verbose=False,
     manual=False,
+    snapshot_cache=False,
+    projection=False,
     chats=None,
     list_chats=None,
     conversation_id=None,
     year=None,
     attachments_only=False,
+    stream=False,
+    copy_mode="copy",
+    use_media_store=False,
+    copy_workers=8,
+    incremental=False,
+    jobs=1,
+    make_thumbs=False,
+    page_size=100,
+    metrics_file=None,
+    profile_dir=None,
+    archive_file=None,
+    shard=None,
+    dataset=False,
 ):
     """
     Read the Signal directory and output attachments and chat files to DEST directory.
@@ -541,8 +1247,18 @@ def main(
      - Windows: ~/AppData/Roaming/Signal
     """
 
-    global log
+    global log, metrics, media_store
     log = verbose
+    if metrics_file:
+        metrics = Metrics(profile_dir)
+    if dataset and (old or incremental or archive_file):
+        print(
+            "Error: --dataset can not be combined with --old, --incremental or --archive"
+        )
+        sys.exit(1)
+    if make_thumbs and not pillow_available():
+        print("Error: --thumbnails needs Pillow, install it with: pip install Pillow")
+        sys.exit(1)
 
     if source:
         src = Path(source)
@@ -564,9 +1280,34 @@ def main(
 
     if log:
         print(f"\nFetching data from {db_file}\n")
+    dest = Path(dest).expanduser()
+    since = load_state(dest) if incremental else None
+
     # print_db_schema(db_file, key)
-    convos, contacts = fetch_data(db_file, key, manual=manual, chats=chats, conversation_id=conversation_id, log=log)
-    convos, contacts = filter_data(convos, contacts, year, attachments_only, log=log)
+    fetch = stream_data if stream else fetch_data
+    if dataset:
+        # messages go from the database cursor to the dataset files
+        fetch = stream_messages
+    with stage("fetch"):
+        convos, contacts = fetch(
+            db_file,
+            key,
+            manual=manual,
+            snapshot=snapshot_cache,
+            chats=chats,
+            conversation_id=conversation_id,
+            year=year,
+            attachments_only=attachments_only,
+            since=since,
+            log=log,
+            projection=projection,
+        )
+    if not stream and not dataset:
+        count("rows", sum(len(messages) for messages in convos.values()), "fetch")
+        with stage("filter"):
+            convos, contacts = filter_data(
+                convos, contacts, year, attachments_only, log=log
+            )
     #convos = filter_by_LLM(convos)
 
     # ... existing code ...
@@ -576,9 +1317,22 @@ def main(
         print("\n".join(names))
         sys.exit()
 
-    dest = Path(dest).expanduser()
     if not dest.is_dir():
         dest.mkdir(parents=True)
+    elif incremental and not (dest / STATE_FILE).is_file() and chat_dirs(dest):
+        # without high-water marks every message would be appended again
+        if not overwrite:
+            print(f"Error: {dest} was not written by an --incremental export")
+            print("Use --overwrite to export it again from scratch.")
+            sys.exit(1)
+        shutil.rmtree(dest)
+        dest.mkdir(parents=True)
+    elif incremental:
+        print(f"Appending new messages to {dest}")
+        layouts = {chat_layout(sub) for sub in chat_dirs(dest)}
+        if layouts - {shard}:
+            print(f"Error: {dest} was not exported with the same --shard option")
+            sys.exit(1)
     elif overwrite:
         shutil.rmtree(dest)
         dest.mkdir(parents=True)
@@ -588,17 +1342,102 @@ def main(
         sys.exit(1)
 
     contacts = fix_names(contacts)
+    senders = build_sender_index(contacts)
+    if dataset:
+        print("\nWriting dataset")
+        with stage("dataset"):
+            count(
+                "messages",
+                export_dataset(dest, convos, contacts, senders, year, attachments_only),
+            )
+        write_metrics(metrics_file)
+        print(f"\nDone! Dataset written to {dest}.\n")
+        return
+    if use_media_store:
+        media_store = MediaStore(dest / STORE_DIR, copy_mode)
+    archive = open_archive(archive_file) if archive_file else None
+    if stream:
+        if old:
+            print("No existing files will be deleted or overwritten!")
+        failures = export_streaming(
+            src,
+            dest,
+            convos,
+            contacts,
+            senders,
+            year,
+            attachments_only,
+            old,
+            copy_mode,
+            copy_workers,
+            since,
+            page_size,
+            archive,
+            shard,
+            max(jobs, 1) if make_thumbs else 0,
+        )
+        if archive is not None:
+            archive.close()
+        report_copy_failures(failures)
+        report_media_store()
+        write_metrics(metrics_file)
+        print(f"\nDone! Files exported to {dest}.\n")
+        return
+
     print("\nCopying and renaming attachments")
-    copy_attachments(src, dest, convos, contacts)
+    with stage("copy attachments"):
+        failures = copy_attachments(
+            src, dest, convos, contacts, copy_mode, copy_workers
+        )
+    report_copy_failures(failures)
     print("\nCreating markdown files")
-    make_simple(dest, convos, contacts)
+    with stage("markdown"):
+        make_simple(dest, convos, contacts, senders, shard)
+        count("messages", sum(len(messages) for messages in convos.values()))
     if old:
         print(f"\nMerging old at {old} into output directory")
         print("No existing files will be deleted or overwritten!")
-        merge_with_old(dest, Path(old))
+        with stage("merge"):
+            merge_with_old(dest, Path(old), shard)
+    names = None
+    if incremental:
+        # conversations without new messages are left untouched
+        names = {contacts[key]["name"] or "None" for key in convos}
+    thumbs = None
+    if make_thumbs:
+        print("\nCreating thumbnails")
+        with stage("thumbnails"):
+            thumbs = make_thumbnails(dest, names, jobs)
     print("\nCreating HTML files")
-    create_html(dest)
-
+    with stage("html"):
+        if incremental:
+            rendered = create_html(
+                dest, page_size, names=names, jobs=jobs, thumbs=thumbs
+            )
+        elif old:
+            rendered = create_html(dest, page_size, jobs=jobs, thumbs=thumbs)
+        else:
+            rendered = create_html(
+                dest,
+                page_size,
+                conversations=convos,
+                contacts=contacts,
+                senders=senders,
+                jobs=jobs,
+                thumbs=thumbs,
+            )
+        count("messages", rendered)
+    if archive is not None:
+        print(f"\nWriting archive {archive_file}")
+        with stage("archive"):
+            count("messages", archive_chats(archive, convos, contacts, senders))
+        archive.close()
+    if incremental:
+        update_state(since, convos)
+        save_state(dest, since)
+
+    report_media_store()
+    write_metrics(metrics_file)
     print(f"\nDone! Files exported to {dest}.\n")
 
 
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import json
+import random
+import sqlite3
+import uuid
+from pathlib import Path
+
+import click
+
+# columns the exporter reads, laid out like Signal Desktop's schema
+SCHEMA = """
+CREATE TABLE conversations(
+    id TEXT PRIMARY KEY ASC,
+    json TEXT,
+    active_at INTEGER,
+    type TEXT,
+    members TEXT,
+    name TEXT,
+    profileName TEXT,
+    e164 TEXT,
+    serviceId TEXT
+);
+CREATE TABLE messages(
+    rowid INTEGER PRIMARY KEY ASC,
+    id TEXT UNIQUE,
+    json TEXT,
+    conversationId TEXT,
+    sent_at INTEGER,
+    received_at INTEGER,
+    type TEXT,
+    body TEXT,
+    hasAttachments INTEGER,
+    source TEXT,
+    sourceServiceId TEXT
+);
+CREATE INDEX messages_conversation ON messages (conversationId, sent_at);
+CREATE TABLE reactions(
+    conversationId TEXT,
+    emoji TEXT,
+    fromId TEXT,
+    messageId TEXT,
+    messageReceivedAt INTEGER,
+    targetAuthorAci TEXT,
+    targetTimestamp INTEGER,
+    unread INTEGER
+);
+CREATE INDEX reactions_message ON reactions (messageId);
+"""
+
+WORDS = (
+    "salut ça va mdr demain soir on se voit ok lol the meeting is at noon "
+    "did you see this https://example.org/article photo trop bien haha "
+    "je suis en retard sorry running late who is coming ce weekend"
+).split()
+
+EMOJIS = ["😂", "👍", "❤️", "😮", "😢", "🙏"]
+
+# (contentType, file extension, whether Signal keeps a fileName)
+ATTACHMENT_TYPES = [
+    ("image/jpeg", ".jpg", True),
+    ("image/png", ".png", True),
+    ("video/mp4", ".mp4", True),
+    ("audio/aac", ".aac", False),
+    ("application/pdf", ".pdf", True),
+]
+
+START = 1_500_000_000_000
+DAY = 86_400_000
+
+
+def generate(
+    dest,
+    chats=20,
+    messages=10_000,
+    groups=5,
+    attachment_ratio=0.05,
+    reaction_ratio=0.05,
+    attachment_size=20_000,
+    seed=0,
+):
+    """Write a fake, unencrypted Signal profile to dest.
+
+    It holds dest/config.json (with a null key), dest/sql/db.sqlite with
+    chats private chats and groups group chats sharing messages messages,
+    and the attachments.noindex tree the messages point to.
+    """
+
+    rng = random.Random(seed)
+    dest = Path(dest)
+    (dest / "sql").mkdir(parents=True, exist_ok=True)
+    with open(dest / "config.json", "w") as f:
+        json.dump({"key": None}, f)
+
+    db_file = dest / "sql" / "db.sqlite"
+    if db_file.exists():
+        db_file.unlink()
+    db = sqlite3.connect(str(db_file))
+    db.executescript(SCHEMA)
+
+    contacts = []
+    for i in range(chats):
+        cid = str(uuid.UUID(int=rng.getrandbits(128)))
+        contact = {
+            "id": cid,
+            "type": "private",
+            "name": f"Contact {i}",
+            "profileName": f"Profile {i}",
+            "e164": f"+3360000{i:04}",
+            "serviceId": str(uuid.UUID(int=rng.getrandbits(128))),
+        }
+        contacts.append(contact)
+    conversations = list(contacts)
+    for i in range(groups):
+        cid = str(uuid.UUID(int=rng.getrandbits(128)))
+        members = rng.sample(contacts, min(len(contacts), rng.randint(3, 12)))
+        conversations.append(
+            {
+                "id": cid,
+                "type": "group",
+                "name": f"Group {i}",
+                "profileName": None,
+                "e164": None,
+                "serviceId": None,
+                "members": members,
+            }
+        )
+    db.executemany(
+        "INSERT INTO conversations "
+        "(id, json, type, members, name, profileName, e164, serviceId) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (
+                c["id"],
+                json.dumps({"id": c["id"], "type": c["type"], "name": c["name"]}),
+                c["type"],
+                " ".join(m["id"] for m in c["members"]) if "members" in c else None,
+                c["name"],
+                c["profileName"],
+                c["e164"],
+                c["serviceId"],
+            )
+            for c in conversations
+        ],
+    )
+
+    att_root = dest / "attachments.noindex"
+    payload = rng.randbytes(attachment_size)
+    message_rows = []
+    reaction_rows = []
+    for n in range(messages):
+        convo = rng.choice(conversations)
+        sent_at = START + n * (5 * 365 * DAY // max(messages, 1))
+        outgoing = rng.random() < 0.4
+        if outgoing:
+            source = None
+        elif convo["type"] == "group":
+            source = rng.choice(convo["members"])
+        else:
+            source = convo
+        msg_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        body = " ".join(rng.choices(WORDS, k=rng.randint(1, 25)))
+
+        attachments = []
+        if rng.random() < attachment_ratio:
+            for i in range(rng.choice([1, 1, 1, 2, 4])):
+                content_type, extension, named = rng.choice(ATTACHMENT_TYPES)
+                name = uuid.UUID(int=rng.getrandbits(128)).hex
+                path = Path(name[:2]) / name
+                (att_root / path).parent.mkdir(parents=True, exist_ok=True)
+                with open(att_root / path, "wb") as f:
+                    f.write(payload)
+                attachments.append(
+                    {
+                        "contentType": content_type,
+                        "path": str(path),
+                        "fileName": f"file{n}_{i}{extension}" if named else None,
+                        "size": attachment_size,
+                    }
+                )
+
+        content = {
+            "id": msg_id,
+            "conversationId": convo["id"],
+            "type": "outgoing" if outgoing else "incoming",
+            "body": body,
+            "sent_at": sent_at,
+            "timestamp": sent_at,
+            "received_at": sent_at + 1000,
+            "attachments": attachments,
+            # never read by the exporter, but part of real payloads
+            "preview": [],
+            "contact": [],
+            "sticker": None,
+            "readStatus": 0,
+        }
+        if source is not None:
+            content["source"] = source["e164"]
+            content["sourceServiceId"] = source["serviceId"]
+        message_rows.append(
+            (
+                msg_id,
+                json.dumps(content),
+                convo["id"],
+                sent_at,
+                sent_at + 1000,
+                content["type"],
+                body,
+                1 if attachments else 0,
+                content.get("source"),
+                content.get("sourceServiceId"),
+            )
+        )
+
+        if rng.random() < reaction_ratio:
+            reactor = rng.choice(convo.get("members", [convo]))
+            reaction_rows.append(
+                (convo["id"], rng.choice(EMOJIS), reactor["id"], msg_id, sent_at + 2000)
+            )
+
+    db.executemany(
+        "INSERT INTO messages (id, json, conversationId, sent_at, received_at, type, "
+        "body, hasAttachments, source, sourceServiceId) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        message_rows,
+    )
+    db.executemany(
+        "INSERT INTO reactions "
+        "(conversationId, emoji, fromId, messageId, messageReceivedAt) "
+        "VALUES (?, ?, ?, ?, ?)",
+        reaction_rows,
+    )
+    db.commit()
+    db.close()
+    return dest
+
+
+@click.command()
+@click.argument("dest", type=click.Path(), default="synthetic")
+@click.option("--chats", type=int, default=20, help="Number of private chats")
+@click.option("--messages", type=int, default=10_000, help="Number of messages")
+@click.option("--groups", type=int, default=5, help="Number of group chats")
+@click.option(
+    "--attachment-ratio",
+    type=float,
+    default=0.05,
+    help="Share of messages with attachments",
+)
+@click.option(
+    "--reaction-ratio",
+    type=float,
+    default=0.05,
+    help="Share of messages with a reaction",
+)
+@click.option(
+    "--attachment-size", type=int, default=20_000, help="Size of each attachment in bytes"
+)
+@click.option("--seed", type=int, default=0, help="Random seed")
+def main(dest, **kwargs):
+    """
+    Write a fake, unencrypted Signal profile to DEST, usable as
+    `sigexport.py --source DEST` or by benchmark.py.
+    """
+
+    generate(dest, **kwargs)
+    print(f"Synthetic Signal profile written to {dest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Thumbnails of the images of an export, shown in the HTML image grids.
+
+Thumbnails are cached in one folder of the export, named by the SHA-256 of
+their source image: an image sent to several chats is thumbnailed once, and
+later exports into the same folder reuse the thumbnails already made.
+Making them needs Pillow.
+"""
+
+import mimetypes
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from attachments import file_hash
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    # optional, only needed with --thumbnails
+    Image = None
+
+THUMB_DIR = ".thumbs"
+THUMB_SIZE = 400
+THUMB_QUALITY = 80
+
+
+def pillow_available():
+    return Image is not None
+
+
+def is_image(path):
+    content_type, _ = mimetypes.guess_type(path.name)
+    return content_type is not None and content_type.startswith("image/")
+
+
+def thumbnail_path(root, digest):
+    return root / digest[:2] / f"{digest}.jpg"
+
+
+def make_thumbnail(src, dst, size=THUMB_SIZE):
+    """Write a JPEG of src, at most size pixels wide and high, to dst."""
+
+    with Image.open(src) as image:
+        # photos are often stored sideways with an EXIF orientation
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        # processes thumbnailing the same image each write their own file
+        tmp = dst.with_name(f"{dst.name}.{os.getpid()}.tmp")
+        image.save(tmp, "JPEG", quality=THUMB_QUALITY)
+    os.replace(tmp, dst)
+
+
+def thumbnail(src, root, size=THUMB_SIZE):
+    """The thumbnail of src in root, made unless it is cached already.
+
+    Returns None if src can not be read as an image.
+    """
+
+    try:
+        dst = thumbnail_path(root, file_hash(src))
+        if not dst.exists():
+            make_thumbnail(src, dst, size)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    return dst
+
+
+def build_thumbnails(folders, root, jobs=1, size=THUMB_SIZE, pool=None):
+    """Thumbnail the images of the media/ folder of conversation folders.
+
+    Images are read and thumbnailed in jobs processes, or by pool, an
+    executor kept by callers thumbnailing one folder at a time. Returns the
+    thumbnails by image file name, by conversation folder name.
+    """
+
+    images = []
+    for folder in folders:
+        media = folder / "media"
+        if media.is_dir():
+            images += [
+                (folder.name, f)
+                for f in sorted(media.iterdir())
+                if f.is_file() and is_image(f)
+            ]
+    sources = [f for _, f in images]
+    if pool is not None:
+        thumbs = list(
+            pool.map(thumbnail, sources, repeat(root), repeat(size), chunksize=16)
+        )
+    elif jobs <= 1:
+        thumbs = [thumbnail(f, root, size) for f in sources]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            thumbs = list(
+                pool.map(thumbnail, sources, repeat(root), repeat(size), chunksize=16)
+            )
+
+    result = {}
+    for (name, f), thumb in zip(images, thumbs):
+        if thumb is not None:
+            result.setdefault(name, {})[f.name] = thumb
+    return result